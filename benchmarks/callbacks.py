@@ -0,0 +1,178 @@
+# Benchmark the Dash callbacks and the figure builder, called directly, on representative selections:
+# the default hub, the ten largest hubs, every hub of the state with the most silos, and the national view,
+# at each threshold. Reports latency percentiles (of the call and the JSON encoding of its result, as Dash
+# sends it), peak Python memory (tracemalloc) and the size of the serialized figure or response.
+# Runs offline on synthetic risk files (see synthetic.py) written to a temporary directory and pre-processed
+# like in production, or on src/risk_files/ with --real.
+# Run from the repository root:
+#   python benchmarks/callbacks.py [--repeat 20] [--json results.json] [--compare baseline.json]
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.normpath(os.path.join(BENCH_DIR, "..", "src"))
+SHAPEFILES = ("BR_Municipios_2019_TRASEID_simplified", "estados_2010")
+
+sys.path.insert(0, BENCH_DIR)
+import synthetic  # noqa: E402
+
+
+# working directory with the data the app loads, and the app imported from it
+def load_app(real, build):
+    if real:
+        os.chdir(SRC_DIR)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="soy-benchmark-")
+        atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+        synthetic.write(work_dir)
+        for name in os.listdir(SRC_DIR):
+            if name.startswith(SHAPEFILES):
+                os.symlink(os.path.join(SRC_DIR, name), os.path.join(work_dir, name))
+        os.chdir(work_dir)
+    sys.path.insert(0, SRC_DIR)
+
+    import datastore
+    import preprocess
+    if build and not real:
+        os.makedirs(datastore.BUILD_DIR, exist_ok=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            preprocess.build_tables()
+            preprocess.build_aggregates()
+            preprocess.build_geometry_tiers()
+
+    import app
+    return app
+
+
+def selections(data):
+    supply_shed, asset_risk = data.supply_shed, data.asset_risk
+    state = asset_risk["destination_state"].value_counts().index[0]
+    return {
+        "default hub": ["NOVA MUTUM"],
+        "top-10 hubs": supply_shed["destination_mun"].value_counts().index[:10].tolist(),
+        f"state ({state})": sorted(asset_risk.loc[asset_risk["destination_state"] == state, "destination_mun"].unique()),
+        "national": [],
+    }
+
+
+# benchmarked calls of a selection at a threshold: name -> (function, serialization of its result)
+def calls(app, mun, threshold):
+    from dash._utils import to_json
+
+    data = app.datastore.get_dataset(threshold)
+    client = app.server.test_client()
+
+    def map_cold():
+        app.figure_cache.clear()
+        return app.update_choropleth_map(mun, ["all"], threshold)
+
+    def download():
+        href, _ = app.update_download_link(mun, ["all"], threshold)
+        return client.get(href).get_data()
+
+    return {
+        "update_destination_company_dropdown": (lambda: app.update_destination_company_dropdown(mun), to_json),
+        "update_choropleth_map": (map_cold, lambda result: to_json(result[0])),
+        "update_choropleth_map (cached)": (lambda: app.update_choropleth_map(mun, ["all"], threshold),
+                                           lambda result: to_json(result[0])),
+        "create_choropleth_figure": (lambda: app.create_choropleth_figure(*data.select(mun, ["all"])), to_json),
+        "update_download_link": (lambda: app.update_download_link(mun, ["all"], threshold), to_json),
+        "download (CSV ZIP)": (download, lambda result: result),
+    }
+
+
+def measure(function, serialize, repeat):
+    payload = serialize(function())
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        serialize(function())
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    serialize(function())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1e3
+    return {"p50_ms": p50, "p90_ms": p90, "p99_ms": p99, "max_ms": max(times) * 1e3,
+            "peak_mb": peak / 2**20, "bytes": len(payload)}
+
+
+def run(app, repeat):
+    results = []
+    data = app.datastore.get_dataset(app.datastore.DEFAULT_THRESHOLD)
+    for selection, mun in selections(data).items():
+        for threshold in app.datastore.THRESHOLDS:
+            for name, (function, serialize) in calls(app, mun, threshold).items():
+                # the company dropdown does not depend on the threshold
+                if name == "update_destination_company_dropdown" and threshold != app.datastore.DEFAULT_THRESHOLD:
+                    continue
+                result = {"callback": name, "selection": selection, "threshold": threshold}
+                result.update(measure(function, serialize, repeat))
+                results.append(result)
+                print(f"{name:<38}{selection:<16}{threshold:>5}{result['p50_ms']:>9.1f}{result['p90_ms']:>9.1f}"
+                      f"{result['p99_ms']:>9.1f}{result['max_ms']:>9.1f}{result['peak_mb']:>9.1f}{result['bytes']:>11}")
+    return results
+
+
+# results slower, heavier or larger than the baseline by more than the tolerance
+def regressions(results, baseline, tolerance):
+    previous = {(result["callback"], result["selection"], result["threshold"]): result for result in baseline}
+    found = []
+    for result in results:
+        base = previous.get((result["callback"], result["selection"], result["threshold"]))
+        if base is None:
+            continue
+        for metric in ("p50_ms", "peak_mb", "bytes"):
+            # ignore changes too small to measure reliably
+            if result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > {
+                    "p50_ms": 1, "peak_mb": 0.5, "bytes": 1024}[metric]:
+                found.append(f"{result['callback']} / {result['selection']} / {result['threshold']}: "
+                             f"{metric} {base[metric]:.1f} -> {result[metric]:.1f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app callbacks on synthetic or real risk files.")
+    parser.add_argument("--real", action="store_true", help="use src/risk_files/ instead of synthetic files")
+    parser.add_argument("--no-build", dest="build", action="store_false",
+                        help="load the synthetic CSV files instead of pre-processing them")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calls per case")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative increase (default 0.25)")
+    args = parser.parse_args()
+
+    # resolve the output paths before changing into the data directory
+    json_path = os.path.abspath(args.json) if args.json else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    app = load_app(args.real, args.build)
+    print(f"{'callback':<38}{'selection':<16}{'thr':>5}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'peak MB':>9}{'bytes':>11}")
+    results = run(app, args.repeat)
+
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(results, file, indent=1)
+    if compare_path:
+        with open(compare_path) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Time create_choropleth_figure for a small, a medium and a national selection, and create_national_figure
+# (the national view drawn from the per-threshold aggregates).
+# Needs the supply shed files in src/risk_files/. Run from the repository root:
+#   python benchmarks/figure_build.py
+import os
+import statistics
+import sys
+import time
+
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.getcwd())
+
+from dash._utils import to_json  # noqa: E402
+
+import app  # noqa: E402
+import datastore  # noqa: E402
+
+REPEAT = 10
+
+
+# (rows drawn from, function building the figure) of each benchmarked selection
+def selections(data):
+    hubs = data.supply_shed["destination_mun"].value_counts().index[:10].tolist()
+    cases = {}
+    for name, mun in (("small (NOVA MUTUM)", ["NOVA MUTUM"]), ("medium (top-10 hubs)", hubs), ("national", [])):
+        supply_shed, asset_risk = data.select(mun, ["all"])
+        cases[name] = (len(supply_shed),
+                       lambda supply_shed=supply_shed, asset_risk=asset_risk: app.create_choropleth_figure(
+                           supply_shed, asset_risk))
+    cases["national (aggregates)"] = (len(data.origin_risk),
+                                      lambda: app.create_national_figure(data.origin_risk, data.asset_risk))
+    return cases
+
+
+def main():
+    data = datastore.get_dataset(datastore.DEFAULT_THRESHOLD)
+    print(f"{'selection':<22}{'rows':>8}{'build ms':>10}{'encode ms':>11}{'bytes':>12}")
+    for name, (rows, create_figure) in selections(data).items():
+        build, encode = [], []
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            figure = create_figure()
+            build.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            payload = to_json(figure)
+            encode.append(time.perf_counter() - start)
+        print(f"{name:<22}{rows:>8}{statistics.median(build) * 1e3:>10.1f}"
+              f"{statistics.median(encode) * 1e3:>11.1f}{len(payload):>12}")
+
+
+if __name__ == "__main__":
+    main()
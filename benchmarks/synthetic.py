@@ -0,0 +1,140 @@
+# Synthetic risk files with the columns of src/risk_files/*.csv (asset risk and supply shed, for every
+# threshold), so the benchmarks run without the real supply shed files. Silos are placed in real
+# municipalities of the shapefile around as many hubs (NOVA MUTUM the largest) and companies as the asset
+# risk files have. Each silo is supplied by its nearest municipalities; the number of links per silo and the
+# at-risk shares are made up, so the data says nothing about the real risk
+#   python benchmarks/synthetic.py OUTPUT_DIR [--silos 1600] [--seed 0]
+import argparse
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+SHAPEFILE = os.path.join(SRC_DIR, "BR_Municipios_2019_TRASEID_simplified.shp")
+
+# soy states and their share of the silos, roughly as in the real asset risk files
+STATE_SHARES = {
+    "MT": 0.43, "RS": 0.14, "PR": 0.13, "BA": 0.07, "MS": 0.06, "GO": 0.05, "MG": 0.04, "SC": 0.03,
+    "SP": 0.02, "TO": 0.01, "MA": 0.01, "PI": 0.005, "PA": 0.005, "RO": 0.005,
+}
+DEFAULT_HUB = "BR-5106224"  # NOVA MUTUM, the default selection of the app
+HUBS = 437
+COMPANIES = 845
+BRANCHES = ["b1.1", "b1.2", "b1.4", "b1.5", "b2.1", "b2.2", "b2.4", "b1.1, b1.2", "b1.4, b1.5", "b1.1, b1.2, b1.5"]
+COMPANY_GROUPS = ["ADM", "AMAGGI", "BUNGE", "CARGIL", "COFCO", "GLENCORE", "LOUIS DREYFUS"]
+# share of the supply links at risk at each threshold, and share of at-risk links making a silo at risk
+AT_RISK_LINKS = {"90": 0.5, "95": 0.4, "99": 0.3}
+AT_RISK_SILO = 0.5
+
+SUPPLY_SHED_COLUMNS = [
+    "origin_cod", "origin_mun", "origin_uf", "origin_biome", "origin_lat", "origin_long",
+    "destination_cod", "destination_mun", "destination_state", "destination_biome", "destination_lat",
+    "destination_long", "destination_cnpj", "destination_company", "destination_dt", "silo_ID", "risk_score",
+]
+ASSET_RISK_COLUMNS = [
+    "silo_ID", "destination_cod", "destination_mun", "destination_state", "destination_biome", "destination_lat",
+    "destination_long", "destination_cnpj", "destination_company", "destination_dt", "company_group", "asset_risk",
+]
+
+
+def municipalities():
+    geo = gpd.read_file(SHAPEFILE).dissolve(by="Geocod", as_index=False)
+    points = geo.geometry.representative_point()
+    return pd.DataFrame({
+        "cod": geo["Geocod"],
+        "mun": geo["NM_MUN"].str.upper(),
+        "uf": geo["SIGLA_UF"],
+        "biome": geo["Biome"],
+        "lat": points.y,
+        "long": points.x,
+    })
+
+
+def generate(silos=1600, seed=0):
+    rng = np.random.default_rng(seed)
+    muns = municipalities()
+
+    # hubs: municipalities of the soy states, with a heavy-tailed number of silos each
+    candidates = muns[muns["uf"].isin(list(STATE_SHARES))]
+    weights = candidates["uf"].map(STATE_SHARES) / candidates.groupby("uf")["uf"].transform("size")
+    hubs = candidates.sample(HUBS - 1, weights=weights, random_state=seed)
+    hubs = pd.concat([muns[muns["cod"] == DEFAULT_HUB], hubs[hubs["cod"] != DEFAULT_HUB]]).head(HUBS)
+    sizes = 1 / np.arange(1, len(hubs) + 1) ** 0.8
+    hub = rng.choice(len(hubs), size=silos, p=sizes / sizes.sum())
+    hub = np.sort(hub)
+    destination = hubs.iloc[hub].reset_index(drop=True)
+
+    companies = np.array([f"SYNTHETIC COMPANY {i:04d}" for i in range(COMPANIES)], dtype=object)
+    cnpjs = rng.integers(10**10, 10**14, size=COMPANIES).astype(float)
+    company = rng.integers(0, COMPANIES, size=silos)
+    asset_risk = pd.DataFrame({
+        "silo_ID": np.arange(1, silos + 1),
+        "destination_cod": destination["cod"],
+        "destination_mun": destination["mun"],
+        "destination_state": destination["uf"],
+        "destination_biome": destination["biome"],
+        "destination_lat": (destination["lat"] + rng.normal(0, 0.05, silos)).round(3),
+        "destination_long": (destination["long"] + rng.normal(0, 0.05, silos)).round(3),
+        "destination_cnpj": cnpjs[company],
+        "destination_company": companies[company],
+        "destination_dt": rng.choice(BRANCHES, size=silos),
+        "company_group": np.where(rng.random(silos) < 0.3, rng.choice(COMPANY_GROUPS, size=silos), "other"),
+    })
+
+    # supply shed: the nearest municipalities of each silo's hub, 5 to 39 per silo
+    hub_lat = np.radians(hubs["lat"].to_numpy())[:, None]
+    hub_long = np.radians(hubs["long"].to_numpy())[:, None]
+    lat = np.radians(muns["lat"].to_numpy())[None, :]
+    long = np.radians(muns["long"].to_numpy())[None, :]
+    cosine = np.sin(hub_lat) * np.sin(lat) + np.cos(hub_lat) * np.cos(lat) * np.cos(long - hub_long)
+    distance = np.arccos(np.clip(cosine, -1, 1))
+    nearest = np.argsort(distance, axis=1)[:, :39]
+    counts = rng.integers(5, 40, size=silos)
+    silo = np.repeat(np.arange(silos), counts)
+    rank = np.arange(len(silo)) - np.repeat(np.cumsum(counts) - counts, counts)
+    origin = muns.iloc[nearest[hub[silo], rank]].reset_index(drop=True)
+    links = asset_risk.iloc[silo].reset_index(drop=True)
+    supply_shed = pd.DataFrame({
+        "origin_cod": origin["cod"],
+        "origin_mun": origin["mun"],
+        "origin_uf": origin["uf"],
+        "origin_biome": origin["biome"],
+        "origin_lat": origin["lat"],
+        "origin_long": origin["long"],
+        **{column: links[column] for column in SUPPLY_SHED_COLUMNS[6:16]},
+    })
+
+    # risk of each link: an origin-level score plus noise, at risk below the share of each threshold
+    origin_score = pd.Series(rng.random(len(muns)), index=muns["cod"])
+    score = 0.7 * origin_score.reindex(supply_shed["origin_cod"]).to_numpy() + 0.3 * rng.random(len(supply_shed))
+    tables = {}
+    for threshold, share in AT_RISK_LINKS.items():
+        at_risk = score < np.quantile(score, share)
+        threshold_supply_shed = supply_shed.assign(risk_score=np.where(at_risk, "At-risk", "Negligible"))
+        silo_share = np.bincount(silo, weights=at_risk, minlength=silos) / counts
+        asset_at_risk = np.where(silo_share > AT_RISK_SILO, "At-risk", "Negligible")
+        threshold_asset_risk = asset_risk.assign(asset_risk=asset_at_risk)
+        tables[threshold] = (threshold_supply_shed[SUPPLY_SHED_COLUMNS], threshold_asset_risk[ASSET_RISK_COLUMNS])
+    return tables
+
+
+# write the files of every threshold into OUTPUT_DIR/risk_files/, named like the real ones
+def write(output_dir, silos=1600, seed=0):
+    risk_files = os.path.join(output_dir, "risk_files")
+    os.makedirs(risk_files, exist_ok=True)
+    for threshold, (supply_shed, asset_risk) in generate(silos, seed).items():
+        supply_shed.to_csv(os.path.join(risk_files, f"soy_supply_shed_trase_2020_threshold_{threshold}%.csv"),
+                           sep=";", index=False)
+        asset_risk.to_csv(os.path.join(risk_files, f"soy_asset_risk_trase_2020_threshold_{threshold}%.csv"),
+                          sep=";", index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic risk files into OUTPUT_DIR/risk_files/.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--silos", type=int, default=1600)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write(args.output_dir, args.silos, args.seed)
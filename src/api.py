@@ -0,0 +1,188 @@
+# Batch queries without the Dash UI: the risk of many silos, companies or municipalities at once.
+# Served as JSON on /api/v1/risk by app.py, or run from src/:
+#   python api.py --threshold 95 --cnpj 95380108091 20374070253 --mun SORRISO
+#   python api.py --dataset soy_2020 --mun SORRISO
+#   python api.py < request.json
+import argparse
+import json
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import datastore
+
+# keys a batch can be made of, and the column of the risk files each one matches
+KEYS = {
+    "cnpj": "destination_cnpj",
+    "company": "destination_company",
+    "mun": "destination_mun",
+}
+
+# asset_risk columns of the silos listed with a result
+silo_columns = [
+    "silo_ID",
+    "destination_cnpj",
+    "destination_company",
+    "destination_mun",
+    "destination_state",
+    "destination_lat",
+    "destination_long",
+    "asset_risk",
+]
+
+
+# number of rows of each value of a column in each risk category, in one pass over the column codes
+def category_counts(frame, column, category_column):
+    categories = list(datastore.risk_color)
+    codes, uniques = pd.factorize(frame[column])
+    category = pd.Categorical(frame[category_column], categories=categories).codes
+    valid = (codes >= 0) & (category >= 0)
+    counts = np.bincount(codes[valid] * len(categories) + category[valid], minlength=len(uniques) * len(categories))
+    return pd.DataFrame(counts.reshape(len(uniques), len(categories)), index=pd.Index(uniques), columns=categories)
+
+
+# risk of every value of a key at a threshold: silos and supply shed links by risk category, and the
+# number of origin municipalities supplying them. Computed once per dataset, threshold and key, then each
+# batch is a lookup of its values. Kept with the data of the threshold, and evicted with it by the registry
+def key_summary(threshold, key, dataset=datastore.DEFAULT_DATASET):
+    data = datastore.get_dataset(threshold, dataset)
+    return data.derived(("key_summary", key), lambda data: summarize_key(data, key))
+
+
+def summarize_key(data, key):
+    column = KEYS[key]
+    silos = category_counts(data.asset_risk, column, "asset_risk")
+    links = category_counts(data.supply_shed, column, "risk_score")
+    origins = data.supply_shed.groupby(column, observed=True)["origin_cod"].nunique()
+    summary = pd.concat([silos.add_prefix("silos_"), links.add_prefix("links_")], axis=1).fillna(0).astype(np.int64)
+    summary["origins"] = origins.reindex(summary.index, fill_value=0).astype(np.int64)
+    return summary
+
+
+# CNPJs are stored as numbers: accept them as numbers or as digit strings, with or without punctuation.
+# Booleans and numbers that are not positive are rejected: 0 stands for a missing CNPJ in the risk files
+def normalize_cnpj(value):
+    digits = re.sub(r"\D", "", value) if isinstance(value, str) else value
+    try:
+        cnpj = float(digits) if not isinstance(value, bool) else np.nan
+    except (TypeError, ValueError):
+        cnpj = np.nan
+    if not np.isfinite(cnpj) or cnpj <= 0:
+        raise ValueError(f"Invalid CNPJ: {value!r}")
+    return cnpj
+
+
+# values of a batch as looked up in the key summary, and the error of each invalid one: an invalid CNPJ is
+# looked up as NaN, which is never found, instead of failing the whole batch
+def lookup_values(key, values):
+    if key != "cnpj":
+        return values, {}
+    lookup, errors = [], {}
+    for i, value in enumerate(values):
+        try:
+            lookup.append(normalize_cnpj(value))
+        except ValueError as error:
+            lookup.append(np.nan)
+            errors[i] = str(error)
+    return lookup, errors
+
+
+# results of a batch request: {'dataset': ..., 'threshold': ..., 'cnpj': [...], 'company': [...], 'mun': [...],
+# 'silos': bool}, one per requested value in request order; an invalid value is not found and its result
+# has an 'error'. Raises ValueError for an invalid request
+def score(request):
+    dataset = str(request.get("dataset", datastore.DEFAULT_DATASET))
+    if dataset not in datastore.datasets():
+        raise ValueError(f"Unknown dataset: {dataset}")
+    threshold = str(request.get("threshold", datastore.DEFAULT_THRESHOLD))
+    if threshold not in datastore.THRESHOLDS:
+        raise ValueError(f"Unknown risk threshold: {threshold}")
+    batches = {key: request.get(key) or [] for key in KEYS}
+    for key, values in batches.items():
+        if not isinstance(values, list):
+            raise ValueError(f"'{key}' must be a list")
+        if key != "cnpj" and not all(isinstance(value, str) for value in values):
+            raise ValueError(f"'{key}' must be a list of names")
+    if not any(batches.values()):
+        raise ValueError(f"Nothing to score: give at least one of {', '.join(KEYS)}")
+
+    data = datastore.get_dataset(threshold, dataset)
+    categories = list(datastore.risk_color)
+    results = []
+    silo_rows = []
+    for key, values in batches.items():
+        if not values:
+            continue
+        lookup, errors = lookup_values(key, values)
+        summary = key_summary(threshold, key, dataset)
+        rows = summary.reindex(lookup, fill_value=0)
+        found = pd.Index(lookup).isin(summary.index)
+        silos = rows[[f"silos_{category}" for category in categories]].to_numpy()
+        links = rows[[f"links_{category}" for category in categories]].to_numpy()
+        origins = rows["origins"].to_numpy()
+
+        for i, value in enumerate(values):
+            result = {
+                "key": key,
+                "value": value,
+                "found": bool(found[i]),
+                "silos": int(silos[i].sum()),
+                "silos_by_risk": dict(zip(categories, silos[i].tolist())),
+                "links": int(links[i].sum()),
+                "links_by_risk": dict(zip(categories, links[i].tolist())),
+                "origins": int(origins[i]),
+            }
+            if i in errors:
+                result["error"] = errors[i]
+            if request.get("silos"):
+                silo_rows.append(data.asset_risk_index.lookup(KEYS[key], [lookup[i]]) if i not in errors
+                                 else np.empty(0, dtype=np.intp))
+            results.append(result)
+
+    if request.get("silos"):
+        add_silo_records(data, results, silo_rows)
+    return {"dataset": dataset, "threshold": threshold, "results": results}
+
+
+# silo records of each result, from its asset_risk rows: only the rows of the batch are serialized, once each
+def add_silo_records(data, results, silo_rows):
+    rows = np.unique(np.concatenate(silo_rows)) if silo_rows else np.empty(0, dtype=np.intp)
+    records = json.loads(data.asset_risk[silo_columns].iloc[rows].to_json(orient="records"))
+    records = dict(zip(rows.tolist(), records))
+    for result, result_rows in zip(results, silo_rows):
+        result["silo_records"] = [records[row] for row in result_rows.tolist()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Risk of a batch of silos (CNPJs), companies and municipalities. "
+                                                 "Reads a JSON request from stdin when no values are given.")
+    parser.add_argument("--dataset", default=datastore.DEFAULT_DATASET, help="<commodity>_<year> of the risk files")
+    parser.add_argument("--threshold", default=datastore.DEFAULT_THRESHOLD, choices=datastore.THRESHOLDS)
+    for key, column in KEYS.items():
+        parser.add_argument(f"--{key}", nargs="+", default=[], help=f"values of {column}")
+    parser.add_argument("--silos", action="store_true", help="list the silos of each result")
+    args = parser.parse_args()
+
+    if any(getattr(args, key) for key in KEYS):
+        request = {key: getattr(args, key) for key in KEYS}
+        request.update(dataset=args.dataset, threshold=args.threshold, silos=args.silos)
+    else:
+        try:
+            request = json.load(sys.stdin)
+        except json.JSONDecodeError as error:
+            parser.error(f"Invalid JSON request: {error}")
+        if not isinstance(request, dict):
+            parser.error("Expected a JSON object")
+
+    try:
+        response = score(request)
+    except ValueError as error:
+        parser.error(str(error))
+    json.dump(response, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,119 @@
-import plotly.express as px
 import dash
-from dash import dcc, html, Input, Output
+from dash import dcc, html, Input, Output, State, Patch, ClientsideFunction
 import plotly.graph_objects as go
-import geopandas as gpd
+import plotly.io as pio
+import os
+from urllib.parse import urlencode
+
+import flask
+import numpy as np
 import pandas as pd
-import base64
-from io import BytesIO
-import zipfile
+
+import api
+import cache
+import datastore
+import export
+import instrument
+import spatial
 
 # Create a Dash app
 app = dash.Dash(__name__)
 server = app.server
 
+# figures of the most recent selections, bounded by count and by the approximate memory they hold
+figure_cache = cache.LRUCache(maxsize=int(os.environ.get("FIGURE_CACHE_SIZE", 64)),
+                              max_bytes=int(os.environ.get("FIGURE_CACHE_MB", 64)) * 2**20,
+                              sizeof=cache.figure_nbytes)
 
-# goejson with limits of municipalities in Brazil
-geo = gpd.read_file("BR_Municipios_2019_TRASEID_simplified.shp",
-                    keep_default_na=True,
-                    )
-geo = (geo[['Geocod', 'geometry']]).rename(columns={'Geocod': 'origin_cod'})
-
-# supply shed area: soy assets in Brazil
-supply_shed = pd.read_csv("risk_files/soy_supply_shed_trase_2020_threshold_90%.csv",
-                          sep=";",
-                          keep_default_na=True
-                          )
-supply_shed = supply_shed.merge(geo, on='origin_cod', how='left')
-supply_shed = gpd.GeoDataFrame(supply_shed, geometry='geometry')
-
-# risk for each asset (silo) in Brazil
-asset_risk = pd.read_csv("risk_files/soy_asset_risk_trase_2020_threshold_90%.csv",
-                         sep=";",
-                         keep_default_na=True
-                         )
-asset_risk = gpd.GeoDataFrame(
-    asset_risk,
-    geometry=gpd.points_from_xy(asset_risk["destination_long"], asset_risk["destination_lat"]),
-)
-risk_color = {
-    "Negligible": "#BBFFEC",
-    "At-risk": "#FF6A5F",
-}
-asset_risk["marker_color"] = asset_risk["asset_risk"].map(risk_color)
+
+# figures of a dataset and threshold the registry evicted go with it (figure keys are datastore.selection_key)
+def drop_figures(dataset, threshold):
+    figure_cache.remove_if(lambda key: key[3] == dataset and key[0] == threshold)
+
+
+datastore.registry.on_evict(drop_figures)
+
+# answer the threshold switch, the company dropdown and the download link in the browser with the
+# functions of assets/clientside.js instead of server callbacks
+CLIENTSIDE_CALLBACKS = os.environ.get("CLIENTSIDE_CALLBACKS", "0") == "1"
+
+
+# load the supply shed and asset risk data of the default dataset at every threshold once, at startup
+with instrument.record("startup"):
+    datastore.preload()
+
+# dropdown options of the default dataset, listed in the layout; other datasets send theirs when selected
+default_municipalities = datastore.get_dataset(datastore.DEFAULT_THRESHOLD).supply_shed['destination_mun'].unique()
+default_companies = datastore.get_dataset(datastore.DEFAULT_THRESHOLD).supply_shed['destination_company'].unique()
+
+# spatial index over the silos and municipality polygons of the default dataset, for the regions selected on
+# the map
+spatial.load_index()
 
 # state boundaries
-state = gpd.read_file("estados_2010.shp",
-                      keep_default_na=True,
-                      )
+state = datastore.load_state()
+
+
+# state boundaries as a static GeoJSON file: the browser fetches it once and reuses it for every figure
+@server.route('/geo/states.geojson')
+def state_geojson():
+    response = flask.Response(datastore.load_state_geojson(), mimetype='application/geo+json')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+
+# silos of each state or biome by risk category, from the aggregates of a threshold
+def summary_table(asset_summary, group, label):
+    categories = list(datastore.risk_color)
+    counts = asset_summary[asset_summary['group'] == group].pivot_table(
+        index='name', columns='asset_risk', values='silos', aggfunc='sum', fill_value=0, observed=True,
+    ).reindex(columns=categories, fill_value=0)
+    return html.Table(
+        style={"fontFamily": "DM Sans", "fontSize": "14px", "marginRight": "40px"},
+        children=[
+            html.Thead(html.Tr([html.Th(label)] + [html.Th(category) for category in categories] + [html.Th("Total")])),
+            html.Tbody([
+                html.Tr([html.Td(str(name))] + [html.Td(int(count)) for count in row] + [html.Td(int(row.sum()))])
+                for name, row in counts.iterrows()
+            ]),
+        ],
+    )
+
+
+# national counts of a threshold: silos and origin municipalities at risk, and silos per state and biome
+def summary_panel(data):
+    silos = data.asset_summary[data.asset_summary['group'] == 'destination_state']
+    at_risk_silos = silos.loc[silos['asset_risk'] == 'At-risk', 'silos'].sum()
+    at_risk_origins = (data.origin_risk['risk_score'] == 'At-risk').sum()
+    return [
+        html.P(
+            f"{silos['silos'].sum()} silos, {at_risk_silos} at risk. "
+            f"{len(data.origin_risk)} origin municipalities, {at_risk_origins} with a supply link at risk.",
+            style={"fontFamily": "DM Sans", "fontSize": "16px", "color": "#000000"},
+        ),
+        html.Div(
+            style={"display": "flex", "alignItems": "flex-start"},
+            children=[
+                summary_table(data.asset_summary, 'destination_state', "State"),
+                summary_table(data.asset_summary, 'destination_biome', "Biome"),
+            ],
+        ),
+    ]
+
+
+# summary panels of a dataset, one per threshold, the one of the selected threshold shown
+def summary_panels(dataset, selected_threshold):
+    return [
+        html.Div(
+            id=f'summary-{threshold}',
+            hidden=threshold != selected_threshold,
+            children=summary_panel(datastore.get_dataset(threshold, dataset)),
+        )
+        for threshold in datastore.THRESHOLDS
+    ]
+
 
 app.layout = html.Div(
     style={"fontFamily": "DM Sans Medium"},
@@ -85,7 +153,8 @@ app.layout = html.Div(
                     "risk based on the risk status of each providing municipality and the respective soy volume "
                     "produced by them. Areas 'at-risk', contribute to 99%, 95%, or 90% of the national soy "
                     "deforestation in 2020 (soy occupying areas deforested between 2015-2019). "
-                    "Click 'download' to access the original data for the selected area.",
+                    "Click 'download' to access the original data for the selected area. "
+                    "Use the box or lasso select of the map to select the municipalities of the silos in a region.",
                     className="card-description",
                     style={
                         "fontFamily": "DM Sans",
@@ -96,6 +165,30 @@ app.layout = html.Div(
                 ),
             ],
         ),
+        # datasets (commodity and year) found in risk_files/, the selector shown when there are several
+        html.Div(
+            hidden=len(datastore.datasets()) < 2,
+            children=[
+                html.Label(
+                    "Select dataset",
+                    style={
+                        "fontFamily": "DM Sans Medium",
+                        "fontSize": "18px",
+                        "color": "#000000",
+                        "marginTop": "10px",
+                        "marginBottom": "5px",
+                    },
+                ),
+                dcc.Dropdown(
+                    id='dataset-dropdown',
+                    options=[{'label': datastore.dataset_label(dataset), 'value': dataset}
+                             for dataset in datastore.datasets()],
+                    value=datastore.DEFAULT_DATASET,
+                    clearable=False,
+                    style={"width": "300px"},
+                ),
+            ],
+        ),
         html.Label(
             "Select risk threshold",
             style={
@@ -127,7 +220,7 @@ app.layout = html.Div(
                         options=[{
                             'label': mun,
                             'value': mun
-                        } for mun in supply_shed['destination_mun'].unique()],
+                        } for mun in default_municipalities],
                         value=['NOVA MUTUM'],  # Default municipalities of destination (as a list)
                         multi=True,  # Allow multiple selections
                         placeholder='Destination Municipality',
@@ -140,7 +233,7 @@ app.layout = html.Div(
                         options=[{
                             'label': company,
                             'value': company
-                        } for company in supply_shed['destination_company'].unique()],
+                        } for company in default_companies],
                         value=['all'],  # Default value to select all companies (as a list)
                         multi=True,  # Allow multiple selections
                         placeholder='Destination Company',
@@ -151,9 +244,26 @@ app.layout = html.Div(
         html.Div(
             className="download_link", children=[
                 html.Div(style={'height': '5px'}),
-                html.A(html.Button('Download CSV'), id='download-link')
+                html.A(html.Button('Download'), id='download-link'),
+                dcc.RadioItems(
+                    id='download-format',
+                    options=[
+                        {"label": "CSV", "value": "csv"},
+                        {"label": "GeoJSON", "value": "geojson"},
+                        {"label": "GeoParquet", "value": "geoparquet"},
+                    ],
+                    value="csv",
+                    labelStyle={"display": "inline-block"},
+                    style={"display": "inline-block", "padding": "10px"},
+                ),
             ]
         ),
+        # national summary of each threshold, the one of the selected threshold shown
+        html.Div(
+            id='summary-panel',
+            style={"padding": "10px"},
+            children=summary_panels(datastore.DEFAULT_DATASET, datastore.DEFAULT_THRESHOLD),
+        ),
         dcc.Loading(
             id="loading-1",
             children=[dcc.Graph(
@@ -167,167 +277,264 @@ app.layout = html.Div(
                 loading_state={"is_loading": True},
             )],
             type="circle"
-        )
+        ),
+        # what the map currently shows, so that later selections are sent as a patch of it
+        dcc.Store(id='map-shown'),
     ],
 )
 
 
-# define map data and layout
-def create_choropleth_figure(supply_shed, asset_risk):
-    state_trace = go.Choropleth(
-        geojson=state.geometry.__geo_interface__,
-        locations=state.index,  # Use the index of the GeoDataFrame as locations
-        z=[0] * len(state),  # Specify a constant value of 0 for all locations (for single fill color)
-        colorscale=[[0, "#E2EAE7"], [1, "#E2EAE7"]],  # Single fill color #BECFC9
-        showscale=False,  # Hide the color scale legend
-        marker=dict(line=dict(color="white", width=1)),  # White borders with width 1
-        name="states_trace",
-    )
+# state basemap, identical for every figure: built once, with its geometry referenced by URL
+# instead of being embedded in each figure response
+state_trace = go.Choropleth(
+    geojson=app.get_relative_path('/geo/states.geojson'),
+    locations=state.index,  # Use the index of the GeoDataFrame as locations
+    z=[0] * len(state),  # Specify a constant value of 0 for all locations (for single fill color)
+    colorscale=[[0, "#E2EAE7"], [1, "#E2EAE7"]],  # Single fill color #BECFC9
+    showscale=False,  # Hide the color scale legend
+    marker=dict(line=dict(color="white", width=1)),  # White borders with width 1
+    name="states_trace",
+    hoverinfo="skip",
+).to_plotly_json()
+
+# map layout shared by every figure (including the default plotly template), validated once
+figure_layout = go.Figure(layout=dict(
+    margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    geo=dict(
+        fitbounds="locations",
+        lonaxis_range=[-100, -10],
+        lataxis_range=[-45, 10],
+        showframe=False,
+        showcoastlines=False,
+        showocean=False,
+        showcountries=False,
+        showland=False,
+    ),
+    legend=dict(
+        yanchor="top",
+        y=0.99,
+        xanchor="left",
+        x=0.01,
+        itemclick="toggleothers",
+        font=dict(family="DM Sans", size=14, color="#839A8C"),
+        title="Risk categories",
+        title_font={"size": 14, "color": "#839A8C", "family": "DM Sans Medium"},
+        bgcolor="rgba(0,0,0,0)",
+    ),
+)).to_plotly_json()['layout']
+
+# supply_shed columns shown when hovering a municipality
+choropleth_hover_columns = [
+    "origin_mun",
+    "origin_uf",
+    "origin_biome",
+    "destination_mun",
+    "destination_state",
+    "destination_biome"
+]
+hovertemplate_choropleth = (
+    "<b><span style='font-family: DM Sans Medium; color: #31464E; font-size: 16px'>%{customdata[0]}</span></b><br><br>"
+    "<span style='position: relative;'>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin state</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[1]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin biome</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[2]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination mun.</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[3]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination state.</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[4]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination biome.</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[5]}</span>"
+    "</span>"
+    "<extra></extra>"
+)
 
-    # Create the main Plotly figure
-    fig = go.Figure()
+# asset_risk columns shown when hovering a silo. Its asset_risk is shown from the trace text instead, so that
+# a threshold switch only resends the text and the colors
+asset_hover_columns = [
+    'destination_company',
+    'destination_cnpj',
+    'destination_lat',
+    'destination_long',
+    'destination_dt',
+]
+hovertemplate_asset = (
+    "<b><span style='font-family: DM Sans Medium; color: #31464E; font-size: 16px'>%{customdata[0]}</span></b><br><br>"
+    "<span style='position: relative;'>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>CNPJ</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[1]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Latitude:</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[2]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Longitude:</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[3]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Associated branches.</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[4]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Risk score.</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{text}</span><br><br>"
+    "</span>"
+    "<extra></extra>"
+)
 
-    # Add the choropleth_trace as the first trace (in the back) to the figure
-    fig.add_trace(state_trace)
-    fig.update_traces(
-        selector=dict(name="states_trace"),
-        hoverinfo="skip"
-    )
-    fig.update_geos(selector=dict(name="states_trace"),
-                    fitbounds='geojson',
-                    lonaxis_range=[-100, -10],
-                    lataxis_range=[-45, 10]
-                    )
-
-    # Create the Plotly Express choropleth trace
-    px_choropleth_trace = px.choropleth(
-        data_frame=supply_shed,
-        locations=supply_shed.index,
-        color="risk_score",
-        color_discrete_map={
-            "Negligible": "#BBFFEC",
-            "At-risk": "#FF6A5F",
-        },
-        geojson=supply_shed.geometry.__geo_interface__,
-        scope="south america",
-        center={"lat": -15, "lon": -55},
-        hover_data=[
-            "origin_mun",
-            "origin_uf",
-            "origin_biome",
-            "destination_mun",
-            "destination_state",
-            "destination_biome"
-        ],
-        title='basemap'
-    )
 
-    # Manually set the hovertemplate for the px_choropleth_trace
-    hovertemplate_px_choropleth = (
-        "<b><span style='font-family: DM Sans Medium; color: #31464E; font-size: 16px'>%{customdata[0]}</span></b><br><br>"
-        "<span style='position: relative;'>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin state</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[1]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin biome</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[2]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination mun.</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[3]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination state.</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[4]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Destination biome.</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[5]}</span>"
-        "</span>"
-        "<extra></extra>"
-    )
+# properties shared by the risk category traces and by the silo trace (also sent to the browser for the
+# clientside threshold switch, see threshold_arrays)
+choropleth_trace_style = {
+    "type": "choropleth",
+    "showlegend": True,
+    "featureidkey": "id",
+    "showscale": False,
+    "hovertemplate": hovertemplate_choropleth,
+    "marker": {"line": {"color": "white", "width": 0.5}},
+    "hoverlabel": {"bgcolor": "#BBFFEC"},
+}
+asset_trace_style = {
+    "type": "scattergeo",
+    "mode": "markers",
+    "marker": {"size": 6, "line": {"color": "black", "width": 0.5}},
+    "hovertemplate": hovertemplate_asset,
+    "hoverlabel": {"bgcolor": "#BBFFEC"},
+    "showlegend": False,
+}
 
-    # Set the hovertemplate for the px_choropleth_trace
-    px_choropleth_trace.update_traces(hovertemplate=hovertemplate_px_choropleth,
-                                      marker_line_width=0.5,
-                                      marker_line_color="white",
-                                      hoverlabel=dict(bgcolor="#BBFFEC"),
-                                      )
-
-    # Add the individual traces from the Plotly Express choropleth figure to the main figure
-    for trace in px_choropleth_trace.data:
-        fig.add_trace(trace)
-
-    fig.update_geos(fitbounds="locations",
-                    lonaxis_range=[-100, -10],
-                    lataxis_range=[-45, 10])
-
-    hovertemplate_asset = (
-        "<b><span style='font-family: DM Sans Medium; color: #31464E; font-size: 16px'>%{customdata[0]}</span></b><br><br>"
-        "<span style='position: relative;'>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>CNPJ</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[1]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Latitude:</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[2]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Longitude:</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[3]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Associated branches.</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[4]}</span><br><br>"
-        "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Risk score.</span><br>"
-        "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[5]}</span><br><br>"
-        "</span>"
-        "<extra></extra>"
-    )
 
-    asset_risk_trace = go.Scattergeo(
-        lat=asset_risk["destination_lat"],
-        lon=asset_risk["destination_long"],
-        mode="markers",
-        marker=dict(size=6, color=asset_risk["marker_color"], line=dict(color="black", width=0.5)),
-        customdata=asset_risk[['destination_company',
-                               'destination_cnpj',
-                               'destination_lat',
-                               'destination_long',
-                               'destination_dt',
-                               'asset_risk']],
-        hovertemplate=hovertemplate_asset,
-        hoverlabel=dict(bgcolor="#BBFFEC"),
-        showlegend=False
-    )
-    fig.add_trace(asset_risk_trace)
-
-    # Set the width of the map to a larger value, e.g., 1000 pixels
-    fig.update_layout(
-        margin={"r": 0, "t": 0, "l": 0, "b": 0},
-        geo=dict(
-            showframe=False,
-            showcoastlines=False,
-            showocean=False,
-            showcountries=False,
-            showland=False,
-        ),
-        legend=dict(
-            yanchor="top",
-            y=0.99,
-            xanchor="left",
-            x=0.01,
-            itemclick="toggleothers",
-            font=dict(family="DM Sans", size=14, color="#839A8C"),
-            title="Risk categories",
-            title_font={"size": 14, "color": "#839A8C", "family": "DM Sans Medium"},
-            bgcolor="rgba(0,0,0,0)",
-        ),
+# origin_risk columns shown when hovering a municipality of the national view
+origin_hover_columns = [
+    "origin_mun",
+    "origin_uf",
+    "origin_biome",
+    "silos",
+    "at_risk_silos",
+]
+hovertemplate_origin = (
+    "<b><span style='font-family: DM Sans Medium; color: #31464E; font-size: 16px'>%{customdata[0]}</span></b><br><br>"
+    "<span style='position: relative;'>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin state</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[1]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Origin biome</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[2]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>Supplied silos</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[3]}</span><br><br>"
+    "<span style='font-family: DM Sans; color: #828F94; font-size: 12px;'>At-risk links</span><br>"
+    "<span style='font-family: DM Sans Medium; color: #31464E;'>%{customdata[4]}</span>"
+    "</span>"
+    "<extra></extra>"
+)
+origin_trace_style = dict(choropleth_trace_style, hovertemplate=hovertemplate_origin)
+
+
+# supply_shed rows to draw: rows drawn identically (same polygon, risk category and hover data, e.g. one
+# origin supplying several silos of a municipality) are only sent once
+def drawn_rows(supply_shed):
+    with instrument.stage("drawn_rows"):
+        return supply_shed[["origin_cod", "risk_score"] + choropleth_hover_columns].drop_duplicates()
+
+
+# whether a selection filters nothing out, and is drawn from the national aggregates
+def is_national(mun, company):
+    return datastore.normalize_selection(mun) == 'all' and datastore.normalize_selection(company) == 'all'
+
+
+# rows drawn for a selection of a threshold: the distinct supply shed rows of the selection, or one row
+# per origin municipality in the national view; with the hover columns and trace style to draw them with
+def drawn_layer(data, mun, company):
+    if is_national(mun, company):
+        return data.origin_risk, origin_hover_columns, origin_trace_style
+    supply_shed, _ = data.select(mun, company)
+    return drawn_rows(supply_shed), choropleth_hover_columns, choropleth_trace_style
+
+
+# municipalities each risk category draws at any threshold of a selection
+def category_locations(mun, company, dataset=datastore.DEFAULT_DATASET):
+    drawn = []
+    for threshold in datastore.THRESHOLDS:
+        data = datastore.get_dataset(threshold, dataset)
+        rows = data.origin_risk if is_national(mun, company) else data.select(mun, company)[0]
+        drawn.append(rows[["origin_cod", "risk_score"]])
+    drawn = pd.concat(drawn, ignore_index=True)
+    origin_cod = drawn["origin_cod"].to_numpy()
+    risk_score = drawn["risk_score"].to_numpy()
+    return {category: pd.unique(origin_cod[risk_score == category]) for category in datastore.risk_color}
+
+
+# one choropleth trace per risk category (in the legend). Each carries the cached features of the
+# municipalities it draws at any threshold of the selection (geometry, see category_locations), or only at
+# this one without it: the traces and their polygons are then the same at every threshold, and a threshold
+# switch sends no geometry. Municipalities are drawn with coarser polygons the more of them are drawn
+def choropleth_traces(drawn, hover_columns, style, geometry=None):
+    instrument.count("drawn_rows", len(drawn))
+    tier = datastore.geometry_tier(drawn["origin_cod"].nunique())
+    origin_cod = drawn["origin_cod"].to_numpy()
+    risk_score = drawn["risk_score"].to_numpy()
+    customdata = drawn[hover_columns].to_numpy()
+
+    traces = []
+    for category, color in datastore.risk_color.items():
+        rows = risk_score == category
+        locations = origin_cod[rows]
+        features = locations if geometry is None else geometry[category]
+        if not len(features):
+            continue
+        with instrument.stage("geometry"):
+            geojson = datastore.feature_collection(features, tier)
+        traces.append(dict(
+            style,
+            name=category,
+            geojson=geojson,
+            meta={"tier": tier},
+            locations=locations,
+            z=np.ones(len(locations), dtype=np.int8),
+            colorscale=[[0, color], [1, color]],  # Single fill color per risk category
+            customdata=customdata[rows],
+        ))
+    return traces
+
+
+# the silos, colored by asset_risk
+def asset_trace(asset_risk):
+    return dict(
+        asset_trace_style,
+        lat=asset_risk["destination_lat"].to_numpy(),
+        lon=asset_risk["destination_long"].to_numpy(),
+        marker=dict(asset_trace_style["marker"], color=asset_risk["marker_color"].to_numpy()),
+        customdata=asset_risk[asset_hover_columns].to_numpy(),
+        text=asset_risk["asset_risk"].to_numpy(),
     )
 
-    return fig
 
-@app.callback(
-    [Output('destination-company-dropdown', 'options'),
-     Output('destination-company-dropdown', 'value')],
-    [Input('destination-mun-dropdown', 'value')]
-)
-def update_destination_company_dropdown(mun):
-    # Filter the supply_shed DataFrame based on the selected municipalities
-    if mun and 'all' not in mun:
-        supply_shed_filtered = supply_shed[supply_shed['destination_mun'].isin(mun)]
-    else:
-        supply_shed_filtered = supply_shed
+# define map data and layout: the figure is assembled as a plain dict straight from the column arrays,
+# the risk category traces on top of the state basemap, then the silos
+def create_choropleth_figure(supply_shed, asset_risk, geometry=None):
+    data = [state_trace] + choropleth_traces(drawn_rows(supply_shed), choropleth_hover_columns,
+                                             choropleth_trace_style, geometry) + [asset_trace(asset_risk)]
+    return {"data": data, "layout": figure_layout}
+
+
+# national view: every origin municipality drawn once from the per-threshold aggregate, instead of one
+# overlapping polygon per supply shed row
+def create_national_figure(origin_risk, asset_risk, geometry=None):
+    data = [state_trace] + choropleth_traces(origin_risk, origin_hover_columns,
+                                             origin_trace_style, geometry) + [asset_trace(asset_risk)]
+    return {"data": data, "layout": figure_layout}
 
-    # Get the unique companies in the filtered supply_shed DataFrame
-    unique_companies = supply_shed_filtered['destination_company'].unique()
+
+# municipalities of a dataset
+def update_destination_mun_options(dataset):
+    data = datastore.get_dataset(datastore.DEFAULT_THRESHOLD, dataset)
+    return [{'label': mun, 'value': mun} for mun in data.supply_shed['destination_mun'].unique()]
+
+
+def update_destination_company_dropdown(mun, dataset=datastore.DEFAULT_DATASET):
+    data = datastore.get_dataset(datastore.DEFAULT_THRESHOLD, dataset)
+
+    # Look up the supply_shed rows of the selected municipalities in the index
+    rows = data.supply_shed_index.rows(mun=mun)
+    companies = data.supply_shed['destination_company'].values
+    if rows is not None:
+        companies = companies[rows]
+    instrument.count("supply_shed_rows", len(companies))
+
+    # Get the unique companies of the selected rows
+    unique_companies = pd.unique(companies)
 
     # Create a list of dictionaries with 'label' and 'value' keys for the dropdown options
     options = [{'label': 'All Companies', 'value': 'all'}] + [{'label': company, 'value': company} for company in unique_companies]
@@ -338,160 +545,435 @@ def update_destination_company_dropdown(mun):
     return options, value
 
 
-@app.callback(
-    Output('choropleth-graph', 'figure'),
-    [
-        Input('destination-mun-dropdown', 'value'),
-        Input('destination-company-dropdown', 'value'),
-        Input('threshold-radio', 'value'),
-    ],
-)
-def update_choropleth_map(mun, company, threshold):
-    # Update the file paths based on the selected threshold
-    supply_shed_file = f"risk_files/soy_supply_shed_trase_2020_threshold_{threshold}%.csv"
-    asset_risk_file = f"risk_files/soy_asset_risk_trase_2020_threshold_{threshold}%.csv"
-
-    # Read the supply_shed and asset_risk DataFrames from the updated file paths
-    supply_shed = pd.read_csv(supply_shed_file, sep=";", keep_default_na=True)
-    supply_shed = supply_shed.merge(geo, on='origin_cod', how='left')
-    supply_shed = gpd.GeoDataFrame(supply_shed, geometry='geometry')
-
-    asset_risk = pd.read_csv(asset_risk_file, sep=";", keep_default_na=True)
-    asset_risk = gpd.GeoDataFrame(
-        asset_risk,
-        geometry=gpd.points_from_xy(asset_risk["destination_long"], asset_risk["destination_lat"]),
-    )
-    risk_color = {
-        "Negligible": "#BBFFEC",
-        "At-risk": "#FF6A5F",
-    }
-    asset_risk["marker_color"] = asset_risk["asset_risk"].map(risk_color)
+# full map figure of a selection, reused from the cache when the same selection was drawn recently
+def build_figure(threshold, mun, company, dataset=datastore.DEFAULT_DATASET):
+    # Reuse the figure of a recent identical selection
+    key = datastore.selection_key(threshold, mun, company, dataset)
+    with instrument.stage("cache"):
+        updated_fig = figure_cache.get(key)
+    if updated_fig is not None:
+        return updated_fig
+
+    # Get the supply_shed and asset_risk DataFrames of the selected dataset and threshold
+    data = datastore.get_dataset(threshold, dataset)
+
+    # Polygons of the selection at every threshold
+    with instrument.stage("geometry"):
+        geometry = category_locations(mun, company, dataset)
 
-    # Check if no municipality is selected in the "Destination Municipality" dropdown
-    if not mun:
-        mun = supply_shed['destination_mun'].unique()
+    # Draw the whole country from the aggregates of the threshold
+    if is_national(mun, company):
+        instrument.count("asset_risk_rows", len(data.asset_risk))
+        with instrument.stage("figure"):
+            updated_fig = create_national_figure(data.origin_risk, data.asset_risk, geometry)
+        figure_cache.put(key, updated_fig)
+        return updated_fig
 
     # Filter the supply_shed and asset_risk DataFrames based on dropdown selections
-    supply_shed_filtered = supply_shed[supply_shed['destination_mun'].isin(mun)]
+    with instrument.stage("select"):
+        supply_shed_filtered, asset_risk_filtered = data.select(mun, company)
+    instrument.count("supply_shed_rows", len(supply_shed_filtered))
+    instrument.count("asset_risk_rows", len(asset_risk_filtered))
 
-    # Convert company to a list if it's a single value
-    if isinstance(company, str):
-        company = [company]
+    # Create a new choropleth map with the filtered DataFrames
+    with instrument.stage("figure"):
+        updated_fig = create_choropleth_figure(supply_shed_filtered, asset_risk_filtered, geometry)
+    figure_cache.put(key, updated_fig)
+    return updated_fig
+
+
+# ids of the GeoJSON features embedded in a trace (None for traces without embedded geometry)
+def feature_ids(trace):
+    geojson = trace.get("geojson")
+    if not isinstance(geojson, dict):
+        return None
+    return [feature["id"] for feature in geojson["features"]]
 
-    if company and 'all' not in company:
-        supply_shed_filtered = supply_shed_filtered[supply_shed_filtered['destination_company'].isin(company)]
 
-    asset_risk_filtered = asset_risk[asset_risk['destination_mun'].isin(mun)]
+# selection key in the form it takes once stored in the browser (JSON lists instead of tuples)
+def shown_key(key):
+    return [value if isinstance(value, str) else list(value) for value in key]
 
-    # Convert company to a list if it's a single value
+
+# description of the figure shown in the browser, kept in the map-shown store: the selection, the geometry
+# tier, the trace names and the feature ids each trace carries
+def shown_figure(key, figure, features):
+    return {
+        "key": shown_key(key),
+        "tier": next((trace["meta"]["tier"] for trace in figure["data"] if "meta" in trace), None),
+        "traces": [trace.get("name") for trace in figure["data"]],
+        "features": features,
+    }
+
+
+def update_choropleth_map(mun, company, threshold, dataset=datastore.DEFAULT_DATASET, shown=None):
+    key = datastore.selection_key(threshold, mun, company, dataset)
+    if shown is not None and shown["key"] == shown_key(key):
+        return dash.no_update, dash.no_update
+
+    updated_fig = build_figure(threshold, mun, company, dataset)
+    traces = updated_fig["data"]
+    features = [feature_ids(trace) for trace in traces]
+    updated_shown = shown_figure(key, updated_fig, features)
+
+    # Send the whole figure on the first render, or when the traces or the polygon tier changed
+    if shown is None or shown["tier"] != updated_shown["tier"] or shown["traces"] != updated_shown["traces"]:
+        return updated_fig, updated_shown
+
+    # Otherwise only send what differs: the per-location arrays of each trace (a threshold switch only
+    # recolors, by moving locations between the risk category traces) and the polygons the browser
+    # does not have yet. Polygons no longer needed stay in their trace, undrawn, until they outnumber
+    # the ones in use, and then the whole figure is sent again. The silos of a selection are the same at
+    # every threshold: a threshold switch only sends their colors and risk
+    threshold_switch = shown["key"][1:] == updated_shown["key"][1:]
+    with instrument.stage("patch"):
+        patch = Patch()
+        for i, trace in enumerate(traces):
+            if trace is state_trace:
+                continue
+            if trace["type"] == "scattergeo":
+                if not threshold_switch:
+                    patch["data"][i]["lat"] = trace["lat"]
+                    patch["data"][i]["lon"] = trace["lon"]
+                    patch["data"][i]["customdata"] = trace["customdata"]
+                patch["data"][i]["marker"]["color"] = trace["marker"]["color"]
+                patch["data"][i]["text"] = trace["text"]
+                continue
+
+            carried = set(shown["features"][i])
+            added = [feature for feature in trace["geojson"]["features"] if feature["id"] not in carried]
+            if len(carried) + len(added) > 2 * len(features[i]):
+                return updated_fig, updated_shown
+
+            patch["data"][i]["locations"] = trace["locations"]
+            patch["data"][i]["z"] = trace["z"]
+            patch["data"][i]["customdata"] = trace["customdata"]
+            if added:
+                patch["data"][i]["geojson"]["features"].extend(added)
+            updated_shown["features"][i] = shown["features"][i] + [feature["id"] for feature in added]
+
+    return patch, updated_shown
+
+
+# what the browser needs to redraw a selection at every threshold without asking the server: the silos are
+# the same at every threshold, only their asset_risk changes, and the drawn rows mostly are too. Each distinct
+# drawn row (polygon and hover data) of any threshold gets a bitmask per threshold of the risk categories
+# (in risk_color order) it is drawn in there. The polygons are taken from the figure already shown, which
+# must be of the selection of the arrays (key, the selection key without its threshold)
+def threshold_arrays(mun, company, dataset=datastore.DEFAULT_DATASET):
+    datasets = [datastore.get_dataset(threshold, dataset) for threshold in datastore.THRESHOLDS]
+    layers = [drawn_layer(data, mun, company) for data in datasets]
+    _, hover_columns, style = layers[0]
+    drawn = pd.concat([layer[0] for layer in layers], ignore_index=True)
+    sizes = [len(layer[0]) for layer in layers]
+
+    # number the distinct drawn rows in order of first appearance
+    key_columns = ["origin_cod"] + hover_columns
+    codes = np.column_stack([pd.factorize(drawn[column])[0] for column in key_columns])
+    _, first, keys = np.unique(codes, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    keys = rank[keys.reshape(-1)]
+    first = first[order]
+
+    categories = list(datastore.risk_color)
+    category = pd.Categorical(drawn["risk_score"], categories=categories).codes
+    masks = {}
+    bounds = np.cumsum([0] + sizes)
+    for threshold, start, stop in zip(datastore.THRESHOLDS, bounds[:-1], bounds[1:]):
+        threshold_rows = np.arange(start, stop)
+        threshold_rows = threshold_rows[category[threshold_rows] >= 0]
+        mask = np.zeros(len(first), dtype=np.uint8)
+        np.bitwise_or.at(mask, keys[threshold_rows], np.left_shift(1, category[threshold_rows]).astype(np.uint8))
+        masks[threshold] = mask
+
+    asset_selections = [data.select(mun, company)[1] for data in datasets]
+    asset_risk = asset_selections[0]
+    asset_risks = {data.threshold: selection["asset_risk"].to_numpy()
+                   for data, selection in zip(datasets, asset_selections)}
+
+    return {
+        "key": shown_key(datastore.selection_key(datastore.DEFAULT_THRESHOLD, mun, company, dataset))[1:],
+        "tier": datastore.geometry_tier(layers[0][0]["origin_cod"].nunique()),
+        "categories": list(datastore.risk_color.items()),
+        "styles": {"choropleth": style, "scattergeo": asset_trace_style},
+        "locations": drawn["origin_cod"].to_numpy()[first],
+        "customdata": drawn[hover_columns].to_numpy()[first],
+        "masks": masks,
+        "assets": {
+            "lat": asset_risk["destination_lat"].to_numpy(),
+            "lon": asset_risk["destination_long"].to_numpy(),
+            "customdata": asset_risk[asset_hover_columns].to_numpy(),
+            "asset_risk": asset_risks,
+        },
+    }
+
+
+# map callback of the clientside mode: only selection changes are drawn by the server, along with the arrays
+# the browser uses to switch the threshold of the selection by itself. The threshold is an Input as well, so
+# that a switch makes Dash drop a response still on its way for the previous threshold, which would be drawn
+# over the switched figure; a switch of the selection shown is left to the browser
+def update_choropleth_map_and_thresholds(mun, company, threshold, dataset=datastore.DEFAULT_DATASET, shown=None):
+    key = datastore.selection_key(threshold, mun, company, dataset)
+    if shown is not None and shown["key"][1:] == shown_key(key)[1:]:
+        return dash.no_update, dash.no_update, dash.no_update
+
+    # when the threshold and the selection changed together, shown may describe the figure from before the
+    # browser switched its threshold: only a figure shown at this threshold is patched
+    if shown is not None and shown["key"][0] != threshold:
+        shown = None
+    updated_fig, updated_shown = update_choropleth_map(mun, company, threshold, dataset, shown)
+    with instrument.stage("threshold_arrays"):
+        arrays = threshold_arrays(mun, company, dataset)
+    return updated_fig, updated_shown, arrays
+
+
+# columns (and their labels) of the downloaded files
+supply_shed_download_columns = {
+    'origin_cod': 'Origin municipality Trase ID (IBGE)',
+    'origin_mun': 'Origin municipality',
+    'origin_uf': 'Origin state',
+    'origin_biome': 'Origin biome',
+    'origin_lat': 'Origin latitude',
+    'origin_long': 'Origin longitude',
+    'destination_cod': 'Destination municipality Trase ID (IBGE)',
+    'destination_mun': 'Destination municipality',
+    'destination_state': 'Destination state',
+    'destination_biome': 'Destination biome',
+    'destination_lat': 'Destination latitude',
+    'destination_long': 'Destination longitude',
+    'destination_cnpj': 'Destination CNPJ',
+    'destination_company': 'Destination company',
+    'destination_dt': 'Destination (trase branch assignment)',
+    'risk_score': 'Risk score',
+}
+asset_risk_download_columns = {
+    'destination_cod': 'Mun. Trase ID (IBGE)',
+    'destination_mun': 'Municipality',
+    'destination_state': 'State',
+    'destination_biome': 'Biome',
+    'destination_lat': 'Latitude',
+    'destination_long': 'Longitude',
+    'destination_cnpj': 'Company CNPJ',
+    'destination_company': 'Company name',
+    'destination_dt': 'Related branch',
+    'asset_risk': 'Asset risk score',
+}
+download_filename = "Asset_and_SupplyShed_data.zip"
+
+
+def update_download_link(mun, company, threshold, file_format='csv', dataset=datastore.DEFAULT_DATASET):
+    # Only point the link to the export endpoint; the ZIP is built when the link is clicked
     if isinstance(company, str):
         company = [company]
+    query = urlencode({'threshold': threshold, 'mun': mun or [], 'company': company or [], 'format': file_format,
+                       'dataset': dataset}, doseq=True)
+
+    return f"{app.get_relative_path('/download')}?{query}", download_filename
+
+
+# destination municipalities of the silos inside the region selected on the map (box or lasso)
+def select_map_region(selected, dataset=datastore.DEFAULT_DATASET):
+    geometry = spatial.selection_geometry(selected)
+    if geometry is None:
+        return dash.no_update
+    with instrument.stage("spatial_query"):
+        silos = spatial.load_index(dataset).silos_in(geometry)
+    instrument.count("silos", len(silos))
+    if not silos:
+        return dash.no_update
+    data = datastore.get_dataset(datastore.DEFAULT_THRESHOLD, dataset)
+    rows = data.asset_risk_index.rows(silo=silos)
+    return sorted(pd.unique(data.asset_risk['destination_mun'].to_numpy()[rows]))
+
+
+# national summaries of the selected dataset
+def update_summary_panel(dataset, threshold):
+    return summary_panels(dataset, threshold)
+
+
+# company lists of the selected dataset, for the company dropdown of the clientside mode
+def update_clientside_data(dataset, clientside_data):
+    return dict(clientside_data, **datastore.get_dataset(datastore.DEFAULT_THRESHOLD, dataset).company_lists())
+
+
+# show the national summary of the selected threshold
+def show_summary(threshold):
+    return [threshold != summary_threshold for summary_threshold in datastore.THRESHOLDS]
+
+
+# export the selected supply shed and assets of a threshold as a ZIP with two files, CSV or with the geometry
+# of each row (GeoJSON, GeoParquet). The ZIP is streamed as it is written, a few thousand rows at a time
+@server.route('/download')
+def download_data():
+    threshold = flask.request.args.get('threshold', datastore.DEFAULT_THRESHOLD)
+    if threshold not in datastore.THRESHOLDS:
+        flask.abort(400, f"Unknown risk threshold: {threshold}")
+    file_format = flask.request.args.get('format', 'csv')
+    if file_format not in export.FORMATS:
+        flask.abort(400, f"Unknown export format: {file_format}")
+    dataset = flask.request.args.get('dataset', datastore.DEFAULT_DATASET)
+    if dataset not in datastore.datasets():
+        flask.abort(400, f"Unknown dataset: {dataset}")
+
+    data = datastore.get_dataset(threshold, dataset)
+    mun = flask.request.args.getlist('mun')
+    company = flask.request.args.getlist('company')
+    files = []
+    for name, frame, index, columns, geometry in (
+        ('supply_shed', data.supply_shed, data.supply_shed_index, supply_shed_download_columns, 'origin'),
+        ('asset_risk', data.asset_risk, data.asset_risk_index, asset_risk_download_columns, 'silo'),
+    ):
+        rows = index.rows(mun, company)
+        if rows is None:
+            rows = np.arange(len(frame))
+        files.append((f"{name}.{export.FORMATS[file_format]}",
+                      export.file_chunks(file_format, frame, rows, columns, geometry)))
+
+    return flask.Response(export.zip_stream(files),
+                          mimetype='application/zip',
+                          headers={'Content-Disposition': f'attachment; filename={download_filename}'})
+
+
+# batch risk queries for pipelines (see api.py): a JSON request in, one result per requested value out
+@server.route('/api/v1/risk', methods=['POST'])
+def batch_risk():
+    request = flask.request.get_json(silent=True)
+    if not isinstance(request, dict):
+        return flask.jsonify(error="Expected a JSON object"), 400
+    try:
+        return flask.jsonify(api.score(request))
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+
+
+# per-callback timings of this process (each gunicorn worker keeps its own), when instrumentation is enabled
+if instrument.ENABLED:
+    instrument.init_app(server)
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.jsonify(pid=os.getpid(),
+                             callbacks=instrument.metrics.summary(),
+                             figure_cache=figure_cache.stats(),
+                             datasets=datastore.registry.stats())
+
+
+selection_inputs = [
+    Input('destination-mun-dropdown', 'value'),
+    Input('destination-company-dropdown', 'value'),
+]
+dataset_input = Input('dataset-dropdown', 'value')
+
+app.callback(
+    Output('destination-mun-dropdown', 'value'),
+    Input('choropleth-graph', 'selectedData'),
+    State('dataset-dropdown', 'value'),
+    prevent_initial_call=True,
+)(instrument.callback(select_map_region))
+
+# the layout holds the municipalities and summaries of the default dataset; other datasets send theirs
+app.callback(
+    Output('destination-mun-dropdown', 'options'),
+    dataset_input,
+    prevent_initial_call=True,
+)(instrument.callback(update_destination_mun_options))
+
+app.callback(
+    Output('summary-panel', 'children'),
+    dataset_input,
+    State('threshold-radio', 'value'),
+    prevent_initial_call=True,
+)(instrument.callback(update_summary_panel))
+
+if CLIENTSIDE_CALLBACKS:
+    # the browser gets the company lists with the page (and those of another dataset when it is selected),
+    # and the threshold arrays of each selection with its map
+    app.layout.children += [
+        dcc.Store(id='map-thresholds'),
+        dcc.Store(id='clientside-data', data=dict(
+            datastore.get_dataset(datastore.DEFAULT_THRESHOLD).company_lists(),
+            download={'url': app.get_relative_path('/download'), 'filename': download_filename},
+        )),
+    ]
+
+    app.callback(
+        Output('clientside-data', 'data'),
+        dataset_input,
+        State('clientside-data', 'data'),
+        prevent_initial_call=True,
+    )(instrument.callback(update_clientside_data))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='soy', function_name='company_options'),
+        Output('destination-company-dropdown', 'options'),
+        Output('destination-company-dropdown', 'value'),
+        Input('destination-mun-dropdown', 'value'),
+        Input('clientside-data', 'data'),
+    )
 
-    if company and 'all' not in company:
-        asset_risk_filtered = asset_risk_filtered[asset_risk_filtered['destination_company'].isin(company)]
+    app.callback(
+        Output('choropleth-graph', 'figure'),
+        Output('map-shown', 'data'),
+        Output('map-thresholds', 'data'),
+        selection_inputs + [Input('threshold-radio', 'value'), dataset_input],
+        State('map-shown', 'data'),
+    )(instrument.callback(update_choropleth_map_and_thresholds))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='soy', function_name='switch_threshold'),
+        Output('choropleth-graph', 'figure', allow_duplicate=True),
+        Output('map-shown', 'data', allow_duplicate=True),
+        Input('threshold-radio', 'value'),
+        State('map-thresholds', 'data'),
+        State('choropleth-graph', 'figure'),
+        State('map-shown', 'data'),
+        prevent_initial_call=True,
+    )
 
-    # Create a new choropleth map with the filtered DataFrames
-    updated_fig = create_choropleth_figure(supply_shed_filtered, asset_risk_filtered)
+    app.clientside_callback(
+        ClientsideFunction(namespace='soy', function_name='download_link'),
+        Output('download-link', 'href'),
+        Output('download-link', 'download'),
+        selection_inputs + [Input('threshold-radio', 'value'), Input('download-format', 'value'), dataset_input],
+        State('clientside-data', 'data'),
+    )
 
-    # Set the value of the destination-company-dropdown to the selected company (or all companies)
-    return updated_fig
+    app.clientside_callback(
+        ClientsideFunction(namespace='soy', function_name='show_summary'),
+        [Output(f'summary-{threshold}', 'hidden') for threshold in datastore.THRESHOLDS],
+        Input('threshold-radio', 'value'),
+    )
+else:
+    app.callback(
+        [Output('destination-company-dropdown', 'options'),
+         Output('destination-company-dropdown', 'value')],
+        [Input('destination-mun-dropdown', 'value'), dataset_input]
+    )(instrument.callback(update_destination_company_dropdown))
+
+    app.callback(
+        Output('choropleth-graph', 'figure'),
+        Output('map-shown', 'data'),
+        selection_inputs + [Input('threshold-radio', 'value'), dataset_input],
+        State('map-shown', 'data'),
+    )(instrument.callback(update_choropleth_map))
+
+    app.callback(
+        Output('download-link', 'href'),
+        Output('download-link', 'download'),
+        selection_inputs + [Input('threshold-radio', 'value'), Input('download-format', 'value'), dataset_input],
+    )(instrument.callback(update_download_link))
+
+    app.callback(
+        [Output(f'summary-{threshold}', 'hidden') for threshold in datastore.THRESHOLDS],
+        Input('threshold-radio', 'value'),
+    )(instrument.callback(show_summary))
 
 
-@app.callback(
-    Output('download-link', 'href'),
-    Output('download-link', 'download'),
-    [
-        Input('destination-mun-dropdown', 'value'),
-        Input('destination-company-dropdown', 'value'),
-    ],
-)
-def update_download_link(mun, company):
-    # Filter the supply_shed and asset_risk DataFrames based on dropdown selections
-    supply_shed_filtered = supply_shed[supply_shed['destination_mun'].isin(mun)]
-    supply_shed_filtered = (supply_shed_filtered[['origin_cod',
-                                                  'origin_mun',
-                                                  'origin_uf',
-                                                  'origin_biome',
-                                                  'origin_lat',
-                                                  'origin_long',
-                                                  'destination_cod',
-                                                  'destination_mun',
-                                                  'destination_state',
-                                                  'destination_biome',
-                                                  'destination_lat',
-                                                  'destination_long',
-                                                  'destination_cnpj',
-                                                  'destination_company',
-                                                  'destination_dt',
-                                                  'risk_score']]).rename(
-        columns={'origin_cod': 'Origin municipality Trase ID (IBGE)',
-                 'origin_mun': 'Origin municipality',
-                 'origin_uf': 'Origin state',
-                 'origin_biome': 'Origin biome',
-                 'origin_lat': 'Origin latitude',
-                 'origin_long': 'Origin longitude',
-                 'destination_cod': 'Destination municipality Trase ID (IBGE)',
-                 'destination_mun': 'Destination municipality',
-                 'destination_state': 'Destination state',
-                 'destination_biome': 'Destination biome',
-                 'destination_lat': 'Destination latitude',
-                 'destination_long': 'Destination longitude',
-                 'destination_cnpj': 'Destination CNPJ',
-                 'destination_company': 'Destination company',
-                 'destination_dt': 'Destination (trase branch assignment)',
-                 'risk_score': 'Risk score'})
-
-    # Convert company to a list if 'all' is selected or multiple companies are selected
-    if 'all' in company or len(company) > 1:
-        company = supply_shed_filtered['Destination company'].unique()
-
-    if 'all' not in company:
-        supply_shed_filtered = supply_shed_filtered[supply_shed_filtered['Destination company'].isin(company)]
-
-    asset_risk_filtered = asset_risk[asset_risk['destination_mun'].isin(mun)]
-    asset_risk_filtered = (asset_risk_filtered[['destination_cod',
-                                                'destination_mun',
-                                                'destination_state',
-                                                'destination_biome',
-                                                'destination_lat',
-                                                'destination_long',
-                                                'destination_cnpj',
-                                                'destination_company',
-                                                'destination_dt',
-                                                'asset_risk']]).rename(
-        columns={'destination_cod': 'Mun. Trase ID (IBGE)',
-                 'destination_mun': 'Municipality',
-                 'destination_state': 'State',
-                 'destination_biome': 'Biome',
-                 'destination_lat': 'Latitude',
-                 'destination_long': 'Longitude',
-                 'destination_cnpj': 'Company CNPJ',
-                 'destination_company': 'Company name',
-                 'destination_dt': 'Related branch',
-                 'asset_risk': 'Asset risk score'})
-
-    # Convert company to a list if 'all' is selected or multiple companies are selected
-    if 'all' in company or len(company) > 1:
-        company = asset_risk_filtered['Company name'].unique()
-
-    if 'all' not in company:
-        asset_risk_filtered = asset_risk_filtered[asset_risk_filtered['Company name'].isin(company)]
-
-    # Create BytesIO buffer to store the ZIP file
-    zip_buffer = BytesIO()
-
-    # Create a ZIP file and add the CSV data as individual files
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        zip_file.writestr('supply_shed.csv', supply_shed_filtered.to_csv(index=False, encoding='utf-8'))
-        zip_file.writestr('asset_risk.csv', asset_risk_filtered.to_csv(index=False, encoding='utf-8'))
-
-    # Encode the ZIP file to base64
-    zip_b64 = base64.b64encode(zip_buffer.getvalue()).decode()
-
-    # Create download link for the ZIP file
-    zip_href = f"data:application/zip;base64,{zip_b64}"
-
-    return zip_href, "Asset_and_SupplyShed_data.zip"
+# Render the default map once at import so plotly's lazily imported modules are loaded up front;
+# under gunicorn this happens in the master process and is shared by the workers (see gunicorn.conf.py)
+pio.to_json(build_figure(datastore.DEFAULT_THRESHOLD, ['NOVA MUTUM'], ['all']))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+// clientside callbacks of the CLIENTSIDE_CALLBACKS mode (see app.py): the company dropdown, the threshold
+// switch and the download link are answered in the browser, from data sent once with the page or the map
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    soy: {
+        // companies of the selected destination municipalities, in the order the server lists them
+        company_options: function(mun, lists) {
+            if (typeof mun === 'string') {
+                mun = [mun];
+            }
+            let companies = lists.companies;
+            if (mun && mun.length && mun.indexOf('all') < 0) {
+                // position of the first row of each company among the rows of the municipalities
+                const first = new Map();
+                mun.forEach(function(name) {
+                    (lists.municipalities[name] || []).forEach(function(pair) {
+                        if (!first.has(pair[0]) || pair[1] < first.get(pair[0])) {
+                            first.set(pair[0], pair[1]);
+                        }
+                    });
+                });
+                companies = Array.from(first.keys())
+                    .sort(function(a, b) { return first.get(a) - first.get(b); })
+                    .map(function(number) { return lists.companies[number]; });
+            }
+
+            const options = [{label: 'All Companies', value: 'all'}].concat(
+                companies.map(function(company) { return {label: company, value: company}; })
+            );
+            return [options, companies.length > 1 ? ['all'] : []];
+        },
+
+        // redraw the map shown at another threshold: the rows and silos stay, their risk categories change
+        switch_threshold: function(threshold, arrays, figure, shown) {
+            const no_update = window.dash_clientside.no_update;
+            if (!arrays || !figure || !shown || shown.key[0] === threshold) {
+                return [no_update, no_update];
+            }
+            // the arrays of another selection than the one shown (its map is still on its way)
+            if (JSON.stringify(arrays.key) !== JSON.stringify(shown.key.slice(1))) {
+                return [no_update, no_update];
+            }
+
+            // polygons already in the figure, whatever risk category trace carries them
+            const features = new Map();
+            figure.data.forEach(function(trace) {
+                if (trace.geojson && typeof trace.geojson === 'object') {
+                    trace.geojson.features.forEach(function(feature) { features.set(feature.id, feature); });
+                }
+            });
+
+            // the state basemap references its geometry by URL and is kept as is
+            const data = figure.data.filter(function(trace) { return typeof trace.geojson === 'string'; });
+            // like the server, a risk category trace carries the polygons of the rows it draws at any threshold
+            const masks = arrays.masks[threshold];
+            const drawnAnywhere = arrays.locations.map(function(location, row) {
+                return Object.values(arrays.masks).reduce(function(any, thresholdMasks) {
+                    return any | thresholdMasks[row];
+                }, 0);
+            });
+            let tier = null;
+            arrays.categories.forEach(function(category, i) {
+                const rows = [];
+                const ids = new Set();
+                masks.forEach(function(mask, row) {
+                    if (mask & (1 << i)) {
+                        rows.push(row);
+                    }
+                    if (drawnAnywhere[row] & (1 << i) && features.has(arrays.locations[row])) {
+                        ids.add(arrays.locations[row]);
+                    }
+                });
+                if (!ids.size) {
+                    return;
+                }
+                const locations = rows.map(function(row) { return arrays.locations[row]; });
+                tier = arrays.tier;
+                data.push(Object.assign({}, arrays.styles.choropleth, {
+                    name: category[0],
+                    geojson: {type: 'FeatureCollection', features: Array.from(ids).map(function(id) { return features.get(id); })},
+                    meta: {tier: tier},
+                    locations: locations,
+                    z: locations.map(function() { return 1; }),
+                    colorscale: [[0, category[1]], [1, category[1]]],
+                    customdata: rows.map(function(row) { return arrays.customdata[row]; }),
+                }));
+            });
+
+            // silos: the risk shown when hovering is their text
+            const colors = Object.fromEntries(arrays.categories);
+            const assetRisk = arrays.assets.asset_risk[threshold];
+            const style = arrays.styles.scattergeo;
+            data.push(Object.assign({}, style, {
+                lat: arrays.assets.lat,
+                lon: arrays.assets.lon,
+                marker: Object.assign({}, style.marker, {
+                    color: assetRisk.map(function(risk) { return colors[risk]; }),
+                }),
+                customdata: arrays.assets.customdata,
+                text: assetRisk,
+            }));
+
+            // described the same way as the server does, so later selections are sent as a patch of it
+            const updated_shown = {
+                key: [threshold].concat(shown.key.slice(1)),
+                tier: tier,
+                traces: data.map(function(trace) { return trace.name === undefined ? null : trace.name; }),
+                features: data.map(function(trace) {
+                    if (!trace.geojson || typeof trace.geojson !== 'object') {
+                        return null;
+                    }
+                    return trace.geojson.features.map(function(feature) { return feature.id; });
+                }),
+            };
+            return [{data: data, layout: figure.layout}, updated_shown];
+        },
+
+        // show the national summary of the selected threshold (one summary-<threshold> output per threshold)
+        show_summary: function(threshold) {
+            return window.dash_clientside.callback_context.outputs_list.map(function(output) {
+                return output.id !== 'summary-' + threshold;
+            });
+        },
+
+        // link to the export endpoint with the current selection
+        download_link: function(mun, company, threshold, file_format, dataset, clientside_data) {
+            const query = new URLSearchParams({threshold: threshold});
+            [].concat(mun || []).forEach(function(value) { query.append('mun', value); });
+            [].concat(company || []).forEach(function(value) { query.append('company', value); });
+            query.append('format', file_format);
+            query.append('dataset', dataset);
+            return [clientside_data.download.url + '?' + query.toString(), clientside_data.download.filename];
+        },
+    },
+});
@@ -0,0 +1,93 @@
+import collections
+import threading
+
+import numpy as np
+
+
+# least recently used cache bounded by a number of entries and by an estimate of the bytes they hold,
+# with hit/miss/eviction counters. on_evict(key, value) is called for each entry evicted to stay in bounds.
+# With keep_latest, the most recent entry is kept even when it alone is over the byte budget
+class LRUCache:
+    def __init__(self, maxsize=128, max_bytes=None, sizeof=None, on_evict=None, keep_latest=False):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.keep_latest = keep_latest
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    # size: the sizeof the value, when the caller already has it
+    def put(self, key, value, size=None):
+        size = self.sizeof(value) if size is None else size
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            # values larger than the whole budget are not kept, unless the latest entry always is
+            if self.max_bytes is not None and size > self.max_bytes and not self.keep_latest:
+                return
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while len(self.entries) > self.maxsize or (self.max_bytes is not None and self.nbytes > self.max_bytes
+                                                       and len(self.entries) > 1):
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    # drop the entries whose key matches a predicate
+    def remove_if(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.nbytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "maxsize": self.maxsize,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# approximate memory held by a figure dict: its arrays and 8 bytes per list item (a reference).
+# Strings and GeoJSON features are shared with the loaded datasets and the feature caches, so they are not counted
+def figure_nbytes(figure):
+    if isinstance(figure, np.ndarray):
+        return figure.nbytes
+    if isinstance(figure, dict):
+        return sum(figure_nbytes(value) for value in figure.values())
+    if isinstance(figure, (list, tuple)):
+        return 8 * len(figure) + sum(figure_nbytes(value) for value in figure if isinstance(value, (dict, np.ndarray)))
+    return 0
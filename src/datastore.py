@@ -0,0 +1,479 @@
+import collections
+import functools
+import json
+import logging
+import os
+import re
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import shapely
+import shapely.geometry
+
+import cache
+import instrument
+
+logger = logging.getLogger(__name__)
+
+# risk thresholds offered by the app
+THRESHOLDS = ("90", "95", "99")
+DEFAULT_THRESHOLD = "90"
+
+# datasets: the risk files of one commodity and year, named <commodity>_<year>
+DEFAULT_DATASET = "soy_2020"
+
+MUNICIPALITY_SHAPEFILE = "BR_Municipios_2019_TRASEID_simplified.shp"
+STATE_SHAPEFILE = "estados_2010.shp"
+RISK_FILES_DIR = "risk_files"
+SUPPLY_SHED_FILE = os.path.join(RISK_FILES_DIR, "{commodity}_supply_shed_trase_{year}_threshold_{threshold}%.csv")
+ASSET_RISK_FILE = os.path.join(RISK_FILES_DIR, "{commodity}_asset_risk_trase_{year}_threshold_{threshold}%.csv")
+# name of the risk files and their built tables, e.g. soy_supply_shed_trase_2020_threshold_90%.csv
+DATASET_FILE_PATTERN = re.compile(
+    r"(?P<commodity>[a-z_]+?)_(?P<table>supply_shed|asset_risk)_trase_(?P<year>\d{4})_threshold_(?P<threshold>\d+)"
+    r"(%\.csv|\.feather)")
+
+# datasets kept in memory by the registry, at most DATASET_CACHE_SIZE (dataset, threshold) pairs and about
+# DATASET_CACHE_MB; the least recently used is evicted first
+DATASET_CACHE_SIZE = int(os.environ.get("DATASET_CACHE_SIZE", 9))
+DATASET_CACHE_MB = int(os.environ.get("DATASET_CACHE_MB", 256))
+
+# pre-processed inputs written by preprocess.py: uncompressed Feather (Arrow IPC) tables read without parsing
+# (see load_table), with the text columns stored as categoricals
+BUILD_DIR = "build"
+SUPPLY_SHED_TABLE = os.path.join(BUILD_DIR, "{commodity}_supply_shed_trase_{year}_threshold_{threshold}.feather")
+ASSET_RISK_TABLE = os.path.join(BUILD_DIR, "{commodity}_asset_risk_trase_{year}_threshold_{threshold}.feather")
+MUNICIPALITY_TABLE = os.path.join(BUILD_DIR, "municipalities.feather")
+STATE_TABLE = os.path.join(BUILD_DIR, "states.feather")
+# per-threshold aggregates of the national view: the risk of each origin municipality and the silo counts
+# of each state and biome by asset_risk
+ORIGIN_RISK_TABLE = os.path.join(BUILD_DIR, "{commodity}_origin_risk_trase_{year}_threshold_{threshold}.feather")
+ASSET_SUMMARY_TABLE = os.path.join(BUILD_DIR, "{commodity}_asset_summary_trase_{year}_threshold_{threshold}.feather")
+
+risk_color = {
+    "Negligible": "#BBFFEC",
+    "At-risk": "#FF6A5F",
+}
+
+
+# goejson with limits of municipalities in Brazil, one (multi)polygon per municipality code
+# (the shapefile has a row for each part of some municipalities)
+def read_geo_source():
+    geo = gpd.read_file(MUNICIPALITY_SHAPEFILE,
+                        keep_default_na=True,
+                        )
+    geo = (geo[['Geocod', 'geometry']]).rename(columns={'Geocod': 'origin_cod'})
+    return geo.dissolve(by='origin_cod', as_index=False)
+
+
+# files making up a shapefile
+def shapefile_parts(shapefile):
+    stem, _ = os.path.splitext(shapefile)
+    return [stem + extension for extension in (".shp", ".shx", ".dbf", ".prj")]
+
+
+# whether a file built by preprocess.py exists and is newer than its sources. A source changed since the
+# build is read instead of the stale file, with a warning to re-run preprocess.py
+def is_built(built_file, source_files):
+    if not os.path.exists(built_file):
+        return False
+    built_time = os.path.getmtime(built_file)
+    changed = [source for source in source_files
+               if os.path.exists(source) and os.path.getmtime(source) > built_time]
+    if changed:
+        logger.warning("%s is older than %s: reading the source instead, re-run preprocess.py",
+                       built_file, ", ".join(changed))
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def load_geo():
+    if is_built(MUNICIPALITY_TABLE, shapefile_parts(MUNICIPALITY_SHAPEFILE)):
+        return gpd.read_feather(MUNICIPALITY_TABLE, memory_map=True)
+    return read_geo_source()
+
+
+# simplification tiers of the municipality polygons, from the finest to the coarsest:
+# (tier, coverage simplification tolerance in degrees, coordinate decimals, most origin municipalities drawn with it)
+GEOMETRY_TIERS = (
+    ("full", 0, 5, 250),
+    ("medium", 0.05, 4, 1500),
+    ("coarse", 0.2, 3, None),
+)
+
+
+# tier used to draw a supply shed with the given number of origin municipalities, so figures with thousands
+# of polygons stay about as heavy as figures of a single silo
+def geometry_tier(n_origins):
+    for tier, _, _, max_origins in GEOMETRY_TIERS:
+        if max_origins is None or n_origins <= max_origins:
+            return tier
+
+
+def features_file(tier):
+    return os.path.join(BUILD_DIR, f"municipalities_{tier}.json")
+
+
+# GeoJSON features of the municipality polygons simplified to a tier, keyed by municipality code.
+# The simplification works on the whole coverage, so neighbouring municipalities keep their shared borders
+def simplify_features(geo, tier):
+    tolerance, decimals = {tier: (tolerance, decimals) for tier, tolerance, decimals, _ in GEOMETRY_TIERS}[tier]
+    geometries = np.asarray(geo.geometry)
+    if tolerance:
+        geometries = shapely.coverage_simplify(geometries, tolerance)
+    geometries = shapely.transform(geometries, lambda coords: np.round(coords, decimals))
+    return {
+        code: {'type': 'Feature', 'id': code, 'geometry': shapely.geometry.mapping(geometry)}
+        for code, geometry in zip(geo['origin_cod'], geometries)
+    }
+
+
+# GeoJSON feature of each municipality polygon keyed by its code, serialized once so figures only
+# reference the features of the selected municipalities (plotted with featureidkey='id').
+# Uses the tier built by preprocess.py when available, otherwise simplifies the shapefile on first use
+@functools.lru_cache(maxsize=None)
+def load_features(tier="full"):
+    if is_built(features_file(tier), shapefile_parts(MUNICIPALITY_SHAPEFILE)):
+        with open(features_file(tier)) as file:
+            return json.load(file)
+    return simplify_features(load_geo(), tier)
+
+
+# GeoJSON FeatureCollection with the cached features of the given municipality codes
+def feature_collection(codes, tier="full"):
+    features = load_features(tier)
+    return {
+        'type': 'FeatureCollection',
+        'features': [features[code] for code in pd.unique(codes) if code in features],
+    }
+
+
+# state boundaries
+def read_state_source():
+    return gpd.read_file(STATE_SHAPEFILE,
+                         keep_default_na=True,
+                         )
+
+
+@functools.lru_cache(maxsize=None)
+def load_state():
+    if is_built(STATE_TABLE, shapefile_parts(STATE_SHAPEFILE)):
+        return gpd.read_feather(STATE_TABLE, memory_map=True)
+    return read_state_source()
+
+
+# inverted index from each destination municipality, company, silo and CNPJ to the (sorted) positions of its rows,
+# so a multi-select is a union/intersection of small integer arrays instead of a scan of the whole frame
+class FrameIndex:
+    columns = ('destination_mun', 'destination_company', 'silo_ID', 'destination_cnpj')
+
+    def __init__(self, frame):
+        self.size = len(frame)
+        self.positions = {column: group_positions(frame[column]) for column in self.columns}
+
+    # approximate memory held: the row positions of each column, and an array view and dict entry per value
+    def nbytes(self):
+        return sum(self.size * np.dtype(np.intp).itemsize + 200 * len(positions)
+                   for positions in self.positions.values())
+
+    # sorted positions of the rows having any of the values in a column
+    def lookup(self, column, values):
+        positions = self.positions[column]
+        found = [positions[value] for value in values if value in positions]
+        if not found:
+            return np.empty(0, dtype=np.intp)
+        if len(found) == 1:
+            return found[0]
+        return np.unique(np.concatenate(found))
+
+    # positions of the rows matching the dropdown selections (and silos, e.g. those of a map region, or CNPJs);
+    # None when nothing is filtered out. An empty selection or the 'all' sentinel does not filter on that column
+    def rows(self, mun=None, company=None, silo=None, cnpj=None):
+        rows = None
+        for column, values in zip(self.columns, (mun, company, silo, cnpj)):
+            values = normalize_selection(values)
+            if values == 'all':
+                continue
+            found = self.lookup(column, values)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        return rows
+
+
+# normalized form of a dropdown selection, equal for selections matching the same rows: a sorted tuple
+# of values, or 'all' for an empty selection or one holding the 'all' sentinel
+def normalize_selection(values):
+    if isinstance(values, str):
+        values = [values]
+    if not values or 'all' in values:
+        return 'all'
+    return tuple(sorted(set(values)))
+
+
+def selection_key(threshold, mun, company, dataset=DEFAULT_DATASET):
+    return str(threshold), normalize_selection(mun), normalize_selection(company), dataset
+
+
+# map each value of a column to the positions of its rows, using the categorical codes of the column
+def group_positions(column):
+    codes, uniques = pd.factorize(column)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    return {value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques)}
+
+
+# state boundaries as pre-serialized GeoJSON, with the row index of each state as the feature id
+@functools.lru_cache(maxsize=None)
+def load_state_geojson():
+    state = load_state()
+    return json.dumps({
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'id': index, 'geometry': feature['geometry']}
+            for index, feature in zip(state.index.tolist(), state.geometry.__geo_interface__['features'])
+        ],
+    }).encode('utf-8')
+
+
+# supply shed and asset risk frames of one dataset and threshold, with their aggregates; supply shed rows
+# reference their polygon by origin_cod
+class ThresholdData:
+    def __init__(self, dataset, threshold, supply_shed, asset_risk, origin_risk, asset_summary):
+        self.dataset = dataset
+        self.threshold = threshold
+        self.supply_shed = supply_shed
+        self.asset_risk = asset_risk
+        self.origin_risk = origin_risk
+        self.asset_summary = asset_summary
+        self.supply_shed_index = FrameIndex(supply_shed)
+        self.asset_risk_index = FrameIndex(asset_risk)
+        self.derived_values = {}
+        self.lock = threading.Lock()
+
+    # a value computed once from this data (e.g. the spatial index of its silos, or a summary of the batch
+    # API), kept with it and freed with it when the registry evicts it
+    def derived(self, name, build):
+        with self.lock:
+            if name not in self.derived_values:
+                self.derived_values[name] = build(self)
+            return self.derived_values[name]
+
+    # approximate memory held by the frames and their indexes
+    def nbytes(self):
+        frames = (self.supply_shed, self.asset_risk, self.origin_risk, self.asset_summary)
+        return int(sum(frame.memory_usage(deep=True).sum() for frame in frames)
+                   + self.supply_shed_index.nbytes() + self.asset_risk_index.nbytes())
+
+    # supply_shed and asset_risk rows matching the dropdown selections and silos
+    def select(self, mun=None, company=None, silo=None):
+        supply_shed_rows = self.supply_shed_index.rows(mun, company, silo)
+        asset_risk_rows = self.asset_risk_index.rows(mun, company, silo)
+        return (self.supply_shed if supply_shed_rows is None else self.supply_shed.iloc[supply_shed_rows],
+                self.asset_risk if asset_risk_rows is None else self.asset_risk.iloc[asset_risk_rows])
+
+    # supply shed companies in order of first appearance, and for each destination municipality the
+    # companies of its rows as [company number, position of its first row] pairs, so the companies of
+    # several municipalities can be listed in the same order as a lookup of their rows in the index
+    def company_lists(self):
+        company_positions = self.supply_shed_index.positions['destination_company']
+        companies = list(company_positions)
+        codes = np.empty(self.supply_shed_index.size, dtype=np.intp)
+        for i, positions in enumerate(company_positions.values()):
+            codes[positions] = i
+
+        municipalities = {}
+        for mun, positions in self.supply_shed_index.positions['destination_mun'].items():
+            numbers, first = np.unique(codes[positions], return_index=True)
+            municipalities[mun] = np.column_stack([numbers, positions[first]]).tolist()
+        return {'companies': companies, 'municipalities': municipalities}
+
+
+# store the text columns as categoricals: one copy of each distinct value plus small integer codes
+def compact(frame):
+    for column in frame.columns[frame.dtypes == object]:
+        frame[column] = frame[column].astype('category')
+    return frame
+
+
+# path of a risk file or table of a dataset and threshold
+def dataset_file(pattern, dataset, threshold):
+    commodity, year = dataset.rsplit("_", 1)
+    return pattern.format(commodity=commodity, year=year, threshold=threshold)
+
+
+# supply shed area: soy assets in Brazil
+def read_supply_shed_source(dataset, threshold):
+    return compact(pd.read_csv(dataset_file(SUPPLY_SHED_FILE, dataset, threshold),
+                               sep=";",
+                               keep_default_na=True
+                               ))
+
+
+# risk for each asset (silo) in Brazil
+def read_asset_risk_source(dataset, threshold):
+    return compact(pd.read_csv(dataset_file(ASSET_RISK_FILE, dataset, threshold),
+                               sep=";",
+                               keep_default_na=True
+                               ))
+
+
+# one row per origin municipality of the supply shed: the most severe risk category of its links to silos
+# (in risk_color order, the one drawn on top when every link is drawn), the silos it supplies and how many
+# of those links are at risk
+def aggregate_origins(supply_shed):
+    categories = list(risk_color)
+    severity = pd.Categorical(supply_shed['risk_score'], categories=categories).codes
+    origins = supply_shed[['origin_cod', 'origin_mun', 'origin_uf', 'origin_biome', 'silo_ID']].assign(
+        severity=severity, at_risk=severity == categories.index('At-risk'))
+    origins = origins.groupby('origin_cod', sort=False, observed=True).agg(
+        origin_mun=('origin_mun', 'first'),
+        origin_uf=('origin_uf', 'first'),
+        origin_biome=('origin_biome', 'first'),
+        severity=('severity', 'max'),
+        silos=('silo_ID', 'nunique'),
+        at_risk_silos=('at_risk', 'sum'),
+    ).reset_index()
+    origins = origins[origins['severity'] >= 0]
+    risk_score = pd.Categorical.from_codes(origins.pop('severity'), categories=categories)
+    return compact(origins.assign(risk_score=risk_score).reset_index(drop=True))
+
+
+# number of silos of each destination state and biome in each asset_risk category, in long form:
+# group (the column counted by), name, asset_risk, silos
+def summarize_assets(asset_risk):
+    counts = []
+    for column in ('destination_state', 'destination_biome'):
+        count = asset_risk.groupby([column, 'asset_risk'], observed=True).size()
+        counts.append(count.rename('silos').reset_index().rename(columns={column: 'name'}).assign(group=column))
+    summary = pd.concat(counts, ignore_index=True)
+    summary['name'] = summary['name'].astype(object)
+    summary['asset_risk'] = summary['asset_risk'].astype(object)
+    return compact(summary[['group', 'name', 'asset_risk', 'silos']])
+
+
+# table built by preprocess.py, or the parsed source file when it has not been built since the source file
+# changed. The table is memory-mapped and converted one block per column (split_blocks): numeric columns
+# without missing values and the codes of the categorical columns stay read-only views of the mapped file,
+# backed by the page cache and shared by every process reading it; the other columns are copied
+def load_table(table_file, source_file, read_source, dataset, threshold):
+    table_file = dataset_file(table_file, dataset, threshold)
+    if is_built(table_file, [dataset_file(source_file, dataset, threshold)]):
+        with instrument.stage("read_table"):
+            return feather.read_table(table_file, memory_map=True).to_pandas(split_blocks=True)
+    with instrument.stage("read_source"):
+        return read_source(dataset, threshold)
+
+
+# (dataset, threshold) pairs with both a supply shed and an asset risk file, as CSV in risk_files/ or as
+# tables built by preprocess.py
+def discover():
+    tables = collections.defaultdict(set)
+    for directory in (RISK_FILES_DIR, BUILD_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = DATASET_FILE_PATTERN.fullmatch(name)
+            if match:
+                key = (f"{match['commodity']}_{match['year']}", match['threshold'])
+                tables[key].add(match['table'])
+    return tuple(sorted(key for key, found in tables.items() if found == {'supply_shed', 'asset_risk'}))
+
+
+# the files are looked up once per process
+@functools.lru_cache(maxsize=None)
+def catalog():
+    return discover()
+
+
+# datasets with risk files at every threshold of the app, the ones it offers
+def datasets():
+    available = set(catalog())
+    names = dict.fromkeys(dataset for dataset, _ in catalog())
+    return [dataset for dataset in names if all((dataset, threshold) in available for threshold in THRESHOLDS)]
+
+
+# name of a dataset in the app, e.g. 'Soy 2020'
+def dataset_label(dataset):
+    commodity, year = dataset.rsplit("_", 1)
+    return f"{commodity.capitalize()} {year}"
+
+
+# read the files of a dataset and threshold
+def load_dataset(dataset, threshold):
+    supply_shed = load_table(SUPPLY_SHED_TABLE, SUPPLY_SHED_FILE, read_supply_shed_source, dataset, threshold)
+    asset_risk = load_table(ASSET_RISK_TABLE, ASSET_RISK_FILE, read_asset_risk_source, dataset, threshold)
+    origin_risk = load_table(ORIGIN_RISK_TABLE, SUPPLY_SHED_FILE, lambda *_: aggregate_origins(supply_shed),
+                             dataset, threshold)
+    asset_summary = load_table(ASSET_SUMMARY_TABLE, ASSET_RISK_FILE, lambda *_: summarize_assets(asset_risk),
+                               dataset, threshold)
+    asset_risk["marker_color"] = asset_risk["asset_risk"].map(risk_color)
+
+    return ThresholdData(dataset, threshold, supply_shed, asset_risk, origin_risk, asset_summary)
+
+
+# datasets loaded on first use and kept in a bounded LRU cache, so serving more years and commodities does not
+# add to the startup time nor keep every one of them in memory. Each (dataset, threshold) pair is loaded once
+# at a time: concurrent requests for it wait for the first load
+class DatasetRegistry:
+    def __init__(self, maxsize=DATASET_CACHE_SIZE, max_bytes=DATASET_CACHE_MB * 2**20):
+        self.cache = cache.LRUCache(maxsize=maxsize, max_bytes=max_bytes, sizeof=ThresholdData.nbytes,
+                                    on_evict=self.evicted, keep_latest=True)
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.listeners = []
+
+    # call listener(dataset, threshold) when the data of a dataset and threshold is evicted, so state kept
+    # elsewhere for it (e.g. the figures of app.py) goes with it
+    def on_evict(self, listener):
+        self.listeners.append(listener)
+
+    def evicted(self, key, data):
+        for listener in self.listeners:
+            listener(*key)
+
+    def get(self, dataset, threshold):
+        key = (dataset, threshold)
+        if key not in catalog():
+            if threshold not in THRESHOLDS:
+                raise ValueError(f"Unknown risk threshold: {threshold!r}")
+            raise ValueError(f"Unknown dataset: {dataset!r}")
+        with self.lock:
+            lock = self.loading.setdefault(key, threading.Lock())
+        with lock:
+            data = self.cache.get(key)
+            if data is None:
+                with instrument.stage("load_dataset"):
+                    data = load_dataset(dataset, threshold)
+                # a pair over the whole budget is still kept, alone, rather than reloaded on every request
+                size = data.nbytes()
+                if size > self.cache.max_bytes:
+                    logger.warning("%s at %s%% takes %.0f MB, more than DATASET_CACHE_MB (%.0f MB): it is the only "
+                                   "pair kept in memory, raise DATASET_CACHE_MB", dataset, threshold, size / 2**20,
+                                   self.cache.max_bytes / 2**20)
+                self.cache.put(key, data, size)
+        return data
+
+    def stats(self):
+        with self.cache.lock:
+            loaded = [list(key) for key in self.cache.entries]
+        return dict(self.cache.stats(), loaded=loaded)
+
+
+registry = DatasetRegistry()
+
+
+# supply shed and asset risk data of a dataset and threshold, loaded on first use
+def get_dataset(threshold=DEFAULT_THRESHOLD, dataset=DEFAULT_DATASET):
+    return registry.get(str(dataset), str(threshold))
+
+
+# load the default dataset at every threshold up front so no callback on it has to touch the disk;
+# the other datasets are loaded when first requested
+def preload():
+    for tier, *_ in GEOMETRY_TIERS:
+        load_features(tier)
+    load_state_geojson()
+    for threshold in THRESHOLDS:
+        get_dataset(threshold)
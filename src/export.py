@@ -0,0 +1,167 @@
+import json
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+import datastore
+
+# export formats of the download endpoint: the extension of the files in the ZIP
+FORMATS = {
+    "csv": "csv",
+    "geojson": "geojson",
+    "geoparquet": "parquet",
+}
+
+# rows converted at a time, so an export holds one chunk of each file in memory whatever its size.
+# GeoJSON chunks are smaller: each row carries the text of its polygon
+CHUNK_ROWS = 5000
+GEOJSON_CHUNK_ROWS = 500
+
+
+# non-seekable sink collecting what zipfile and the Parquet writer write until it is sent.
+# zipfile writes data descriptors after each file instead of seeking back to its header
+class StreamSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    @property
+    def closed(self):
+        return False
+
+    # bytes written since the last call
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# ZIP archive of the given (name, byte chunks) files, produced as it is sent
+def zip_stream(files):
+    sink = StreamSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for name, chunks in files:
+            with zip_file.open(name, "w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+# consecutive chunks of the given rows (positions) of a frame
+def row_chunks(frame, rows, chunk_rows=CHUNK_ROWS):
+    for start in range(0, len(rows), chunk_rows):
+        yield frame.iloc[rows[start:start + chunk_rows]]
+
+
+# export columns of a chunk, renamed to their labels
+def export_columns(chunk, columns):
+    return chunk[list(columns)].rename(columns=columns)
+
+
+def csv_chunks(frame, rows, columns):
+    yield export_columns(frame.iloc[:0], columns).to_csv(index=False).encode("utf-8")
+    for chunk in row_chunks(frame, rows):
+        yield export_columns(chunk, columns).to_csv(index=False, header=False).encode("utf-8")
+
+
+# GeoJSON geometries of a frame's rows: the polygon of their origin municipality, or the point of their silo
+def origin_geometries(frame):
+    features = datastore.load_features("full")
+    return [features[code]["geometry"] if code in features else None for code in frame["origin_cod"]]
+
+
+def silo_geometries(frame):
+    return [{"type": "Point", "coordinates": [lon, lat]}
+            for lon, lat in zip(frame["destination_long"].tolist(), frame["destination_lat"].tolist())]
+
+
+def geojson_chunks(frame, rows, columns, geometries):
+    yield b'{"type":"FeatureCollection","features":['
+    separator = b""
+    for chunk in row_chunks(frame, rows, GEOJSON_CHUNK_ROWS):
+        properties = json.loads(export_columns(chunk, columns).to_json(orient="records"))
+        features = [{"type": "Feature", "properties": row, "geometry": geometry}
+                    for row, geometry in zip(properties, geometries(chunk))]
+        if features:
+            yield separator + ",".join(json.dumps(feature) for feature in features).encode("utf-8")
+            separator = b","
+    yield b"]}"
+
+
+# WKB geometries of a frame's rows, as in the GeoJSON export
+def origin_wkb(frame):
+    geo = datastore.load_geo()
+    positions = pd.Index(geo["origin_cod"]).get_indexer(frame["origin_cod"])
+    geometries = np.asarray(geo.geometry)[positions]
+    geometries[positions < 0] = None
+    return shapely.to_wkb(geometries)
+
+
+def silo_wkb(frame):
+    return shapely.to_wkb(shapely.points(frame["destination_long"].to_numpy(), frame["destination_lat"].to_numpy()))
+
+
+# GeoParquet metadata of a WKB geometry column, in the CRS of the municipality shapefile
+def geoparquet_metadata(geometry_types):
+    crs = datastore.load_geo().crs
+    return {"geo": json.dumps({
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {
+            "encoding": "WKB",
+            "geometry_types": geometry_types,
+            "crs": crs.to_json_dict() if crs is not None else None,
+        }},
+    })}
+
+
+# GeoParquet file written one row group per chunk
+def geoparquet_chunks(frame, rows, columns, geometries, geometry_types):
+    sink = StreamSink()
+    columns_schema = pa.Schema.from_pandas(export_columns(frame.iloc[:0], columns), preserve_index=False)
+    schema = columns_schema.append(pa.field("geometry", pa.binary()))
+    schema = schema.with_metadata(dict(schema.metadata or {}, **geoparquet_metadata(geometry_types)))
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in row_chunks(frame, rows):
+            table = pa.Table.from_pandas(export_columns(chunk, columns), schema=columns_schema, preserve_index=False)
+            table = table.append_column("geometry", pa.array(geometries(chunk), pa.binary()))
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+            yield sink.drain()
+    yield sink.drain()
+
+
+# geometry of the exported rows: (GeoJSON geometries, WKB geometries, GeoParquet geometry types)
+GEOMETRIES = {
+    "origin": (origin_geometries, origin_wkb, ["Polygon", "MultiPolygon"]),
+    "silo": (silo_geometries, silo_wkb, ["Point"]),
+}
+
+
+# byte chunks of one exported file: the given rows of a frame in a format, with the geometry of each row
+# (the polygon of its origin municipality or the point of its silo) in the geographic formats
+def file_chunks(file_format, frame, rows, columns, geometry):
+    geometries, wkb, geometry_types = GEOMETRIES[geometry]
+    if file_format == "csv":
+        return csv_chunks(frame, rows, columns)
+    if file_format == "geojson":
+        return geojson_chunks(frame, rows, columns, geometries)
+    if file_format == "geoparquet":
+        return geoparquet_chunks(frame, rows, columns, wkb, geometry_types)
+    raise ValueError(f"Unknown export format: {file_format!r}")
@@ -0,0 +1,17 @@
+# gunicorn settings for app:server, used by render.yaml:
+#   gunicorn --chdir src --config src/gunicorn.conf.py app:server
+import gc
+import os
+
+# Import app.py, and so load every dataset, once in the master process before forking the workers.
+# The workers share those pages copy-on-write instead of each parsing and holding its own copy
+preload_app = True
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+
+# Move everything loaded so far out of the garbage collector's reach: collections in the workers would
+# otherwise write to every shared object's header and turn the shared pages into private copies
+def when_ready(server):
+    gc.collect()
+    gc.freeze()
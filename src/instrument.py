@@ -0,0 +1,191 @@
+import cProfile
+import collections
+import contextlib
+import functools
+import os
+import threading
+import time
+
+import flask
+import numpy as np
+
+# opt-in timing of the Dash callbacks, off unless PROFILE_CALLBACKS=1: per-stage timings, row counts and
+# response sizes of each callback request, summarized on /metrics (see app.py)
+ENABLED = os.environ.get("PROFILE_CALLBACKS", "0") == "1"
+# when set (and enabled), a cProfile dump of every callback request is written to this directory
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+# most recent requests of each callback kept for the summary
+WINDOW = int(os.environ.get("PROFILE_WINDOW", 1000))
+
+
+# timings (seconds) of the stages of one request, the rows it handled and the size of its response.
+# Stages may nest (e.g. geometry inside figure); a stage entered several times adds up
+class Record:
+    def __init__(self, name):
+        self.name = name
+        self.stages = collections.defaultdict(float)
+        self.rows = {}
+        self.bytes = None
+
+
+# most recent records of each callback, and their summary
+class Metrics:
+    def __init__(self, window=WINDOW):
+        self.records = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records[record.name].append(record)
+            self.counts[record.name] += 1
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.counts.clear()
+
+    # per callback: the number of requests, and over the most recent ones the percentiles (ms) of each stage,
+    # the mean and max of each row count, and the percentiles of the response size
+    def summary(self):
+        with self.lock:
+            records = {name: list(deque) for name, deque in self.records.items()}
+            counts = dict(self.counts)
+        summary = {}
+        for name, window in records.items():
+            stages = {}
+            for stage in dict.fromkeys(stage for record in window for stage in record.stages):
+                times = np.array([record.stages[stage] for record in window if stage in record.stages]) * 1e3
+                stages[stage] = distribution(times)
+            rows = {}
+            for column in dict.fromkeys(column for record in window for column in record.rows):
+                values = np.array([record.rows[column] for record in window if column in record.rows])
+                rows[column] = {"mean": float(values.mean()), "max": int(values.max())}
+            sizes = np.array([record.bytes for record in window if record.bytes is not None])
+            summary[name] = {
+                "requests": counts[name],
+                "window": len(window),
+                "stages_ms": stages,
+                "rows": rows,
+                "bytes": distribution(sizes) if len(sizes) else None,
+            }
+        return summary
+
+
+def distribution(values):
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(values.max()),
+            "mean": float(values.mean())}
+
+
+metrics = Metrics()
+local = threading.local()
+
+
+# time a stage of the request being recorded in this thread; does nothing otherwise
+@contextlib.contextmanager
+def stage(name):
+    record = getattr(local, "record", None)
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.stages[name] += time.perf_counter() - start
+
+
+# number of rows a stage of the recorded request handled
+def count(name, rows):
+    record = getattr(local, "record", None)
+    if record is not None:
+        record.rows[name] = rows
+
+
+# record everything done in this thread inside the block under a name, e.g. the startup of a process
+@contextlib.contextmanager
+def record(name):
+    if not ENABLED:
+        yield
+        return
+    local.record = Record(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current, local.record = local.record, None
+        current.stages["total"] = time.perf_counter() - start
+        metrics.add(current)
+
+
+def start_profile():
+    if not PROFILE_DIR:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is already running (Python 3.12+ allows one at a time)
+        return None
+    return profiler
+
+
+def dump_profile(profiler, name):
+    if profiler is None:
+        return
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}-{time.time_ns()}-{os.getpid()}.prof"))
+
+
+# a Dash callback, recorded when instrumentation is enabled. In a request, Dash encodes the return value
+# after the callback returns: the record is completed by the after_request hook installed by init_app, with
+# the encoding time and the response size
+def callback(function):
+    if not ENABLED:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        local.record = current = Record(function.__name__)
+        profiler = start_profile()
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException:
+            if profiler is not None:
+                profiler.disable()
+            raise
+        finally:
+            local.record = None
+        end = time.perf_counter()
+        current.stages["callback"] = end - start
+        if flask.has_request_context():
+            flask.g.instrument = (current, profiler, end)
+        else:
+            dump_profile(profiler, current.name)
+            metrics.add(current)
+        return result
+
+    return wrapper
+
+
+# request hooks completing the records of the callbacks
+def init_app(server):
+    @server.before_request
+    def start_request():
+        flask.g.instrument_start = time.perf_counter()
+
+    @server.after_request
+    def finish_request(response):
+        if "instrument" in flask.g:
+            current, profiler, callback_end = flask.g.pop("instrument")
+            end = time.perf_counter()
+            current.stages["encode"] = end - callback_end
+            current.stages["request"] = end - flask.g.instrument_start
+            if not response.is_streamed:
+                current.bytes = response.content_length
+            dump_profile(profiler, current.name)
+            metrics.add(current)
+        return response
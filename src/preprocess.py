@@ -0,0 +1,56 @@
+# Offline build step: writes the pre-processed inputs loaded by app.py into build/.
+# Run it from src/ whenever the shapefiles or the risk files change (the app reads a source file instead of
+# its built table when the source is newer, and warns about it):
+#   python preprocess.py
+import json
+import os
+
+import datastore
+
+
+# municipality polygons simplified to each geometry tier, as GeoJSON features keyed by municipality code
+def build_geometry_tiers():
+    geo = datastore.load_geo()
+    for tier, *_ in datastore.GEOMETRY_TIERS:
+        path = datastore.features_file(tier)
+        with open(path, "w") as file:
+            json.dump(datastore.simplify_features(geo, tier), file, separators=(",", ":"))
+        print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+# risk files of every dataset and shapefiles as uncompressed Feather tables, so the app reads them without
+# parsing
+def build_tables():
+    for dataset, threshold in datastore.catalog():
+        for table_file, read_source in ((datastore.SUPPLY_SHED_TABLE, datastore.read_supply_shed_source),
+                                        (datastore.ASSET_RISK_TABLE, datastore.read_asset_risk_source)):
+            write_table(read_source(dataset, threshold), datastore.dataset_file(table_file, dataset, threshold))
+    write_table(datastore.read_geo_source(), datastore.MUNICIPALITY_TABLE)
+    write_table(datastore.read_state_source(), datastore.STATE_TABLE)
+
+
+# per-threshold aggregates of the national view, from the tables built above
+def build_aggregates():
+    for dataset, threshold in datastore.catalog():
+        supply_shed = datastore.load_table(datastore.SUPPLY_SHED_TABLE, datastore.SUPPLY_SHED_FILE,
+                                           datastore.read_supply_shed_source, dataset, threshold)
+        asset_risk = datastore.load_table(datastore.ASSET_RISK_TABLE, datastore.ASSET_RISK_FILE,
+                                          datastore.read_asset_risk_source, dataset, threshold)
+        write_table(datastore.aggregate_origins(supply_shed),
+                    datastore.dataset_file(datastore.ORIGIN_RISK_TABLE, dataset, threshold))
+        write_table(datastore.summarize_assets(asset_risk),
+                    datastore.dataset_file(datastore.ASSET_SUMMARY_TABLE, dataset, threshold))
+
+
+# written to a new file then renamed over the old one, so a running app keeps its memory map of the old file
+def write_table(frame, path):
+    frame.to_feather(path + ".tmp", compression="uncompressed")
+    os.replace(path + ".tmp", path)
+    print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    os.makedirs(datastore.BUILD_DIR, exist_ok=True)
+    build_tables()
+    build_aggregates()
+    build_geometry_tiers()
@@ -0,0 +1,88 @@
+import functools
+
+import numpy as np
+import shapely
+
+import datastore
+
+# mean Earth radius, in km
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+# R-trees (shapely STRtree) over the silo points and the municipality polygons, so a map region is resolved
+# to the silos and municipalities it covers without testing every one of them. The municipality tree is the
+# same for every dataset (see load_municipality_tree). Coordinates are (longitude, latitude) degrees
+class SpatialIndex:
+    def __init__(self, asset_risk):
+        self.silo_ids = asset_risk['silo_ID'].to_numpy()
+        self.silo_lon = asset_risk['destination_long'].to_numpy()
+        self.silo_lat = asset_risk['destination_lat'].to_numpy()
+        self.silo_tree = shapely.STRtree(shapely.points(self.silo_lon, self.silo_lat))
+        self.municipality_codes, self.municipality_tree = load_municipality_tree()
+
+    # silo_IDs of the silos inside a geometry (e.g. a lasso polygon), in asset_risk order
+    def silos_in(self, geometry):
+        return self.silo_ids[np.sort(self.silo_tree.query(geometry, predicate='intersects'))].tolist()
+
+    def silos_in_bbox(self, west, south, east, north):
+        return self.silos_in(shapely.box(west, south, east, north))
+
+    # silo_IDs of the silos at most km away from a point (great-circle distance), nearest first
+    def silos_within(self, lon, lat, km):
+        # candidates from the bounding box of the circle, then the exact distance of those only
+        dlat = km / KM_PER_DEGREE
+        dlon = min(dlat / max(np.cos(np.radians(lat)), 1e-6), 180)
+        candidates = self.silo_tree.query(shapely.box(lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+        distances = haversine_km(lon, lat, self.silo_lon[candidates], self.silo_lat[candidates])
+        order = np.argsort(distances, kind='stable')
+        order = order[distances[order] <= km]
+        return self.silo_ids[candidates[order]].tolist()
+
+    # codes of the municipalities whose polygon intersects a geometry
+    def municipalities_in(self, geometry):
+        return self.municipality_codes[np.sort(self.municipality_tree.query(geometry, predicate='intersects'))].tolist()
+
+    def municipalities_in_bbox(self, west, south, east, north):
+        return self.municipalities_in(shapely.box(west, south, east, north))
+
+
+def haversine_km(lon, lat, lons, lats):
+    lon, lat, lons, lats = map(np.radians, (lon, lat, lons, lats))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+# codes of the municipalities and the R-tree over their polygons, built once for all the datasets
+@functools.lru_cache(maxsize=None)
+def load_municipality_tree():
+    geo = datastore.load_geo()
+    return geo['origin_cod'].to_numpy(), shapely.STRtree(np.asarray(geo.geometry))
+
+
+# the silos of a dataset are the same at every threshold, so a single index serves all of them. It is kept
+# with the default threshold of the dataset in the registry, and evicted with it
+def load_index(dataset=datastore.DEFAULT_DATASET):
+    data = datastore.get_dataset(datastore.DEFAULT_THRESHOLD, dataset)
+    return data.derived("spatial_index", lambda data: SpatialIndex(data.asset_risk))
+
+
+# region selected on the map (the selectedData of a box or lasso select on the geo subplot) as a geometry;
+# None when nothing is selected
+def selection_geometry(selected):
+    if not selected:
+        return None
+    if 'geo' in selected.get('range', {}):
+        (lon0, lat0), (lon1, lat1) = selected['range']['geo']
+        return shapely.box(min(lon0, lon1), min(lat0, lat1), max(lon0, lon1), max(lat0, lat1))
+    if len(selected.get('lassoPoints', {}).get('geo', [])) >= 3:
+        return shapely.make_valid(shapely.Polygon(selected['lassoPoints']['geo']))
+    return None
+
+
+# supply_shed and asset_risk rows of a threshold for the silos inside a geometry, looked up in the indexes
+def select_region(data, geometry):
+    silos = load_index(data.dataset).silos_in(geometry)
+    if not silos:
+        return data.supply_shed.iloc[:0], data.asset_risk.iloc[:0]
+    return data.select(silo=silos)
@@ -0,0 +1,38 @@
+# The supply shed files are not in the repository: the tests run on synthetic risk files (see
+# benchmarks/synthetic.py) written with links to the shapefiles into a temporary directory, which the modules
+# of src/ then read their relative paths from. Run from the repository root:
+#   python -m pytest
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+BENCH_DIR = os.path.join(ROOT_DIR, "benchmarks")
+SHAPEFILES = ("BR_Municipios_2019_TRASEID_simplified", "estados_2010")
+
+sys.path[:0] = [SRC_DIR, BENCH_DIR]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def data_dir(tmp_path_factory):
+    import synthetic
+
+    path = tmp_path_factory.mktemp("data")
+    synthetic.write(str(path), silos=400)
+    for name in os.listdir(SRC_DIR):
+        if name.startswith(SHAPEFILES):
+            os.symlink(os.path.join(SRC_DIR, name), os.path.join(path, name))
+    cwd = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(cwd)
+
+
+# the data of the 95% threshold
+@pytest.fixture(scope="session")
+def data(data_dir):
+    import datastore
+
+    return datastore.get_dataset("95")
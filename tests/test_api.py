@@ -0,0 +1,99 @@
+# Batch API results, checked against filters of the risk files
+import json
+
+import pytest
+
+import api
+import datastore
+
+CATEGORIES = list(datastore.risk_color)
+
+
+# the result of a value, computed by filtering the frames
+def expected_result(data, key, value, lookup=None):
+    column = api.KEYS[key]
+    lookup = value if lookup is None else lookup
+    silos = data.asset_risk[data.asset_risk[column] == lookup]
+    links = data.supply_shed[data.supply_shed[column] == lookup]
+    silos_by_risk = {category: int((silos["asset_risk"] == category).sum()) for category in CATEGORIES}
+    links_by_risk = {category: int((links["risk_score"] == category).sum()) for category in CATEGORIES}
+    return {
+        "key": key,
+        "value": value,
+        "found": bool(len(silos) or len(links)),
+        "silos": sum(silos_by_risk.values()),
+        "silos_by_risk": silos_by_risk,
+        "links": sum(links_by_risk.values()),
+        "links_by_risk": links_by_risk,
+        "origins": int(links["origin_cod"].nunique()),
+    }
+
+
+def test_results_match_filters(data):
+    mun = data.supply_shed["destination_mun"].value_counts().index[:5].tolist() + ["NOT A MUNICIPALITY"]
+    company = data.asset_risk["destination_company"].drop_duplicates().iloc[:5].tolist()
+    cnpj = data.asset_risk.loc[data.asset_risk["destination_cnpj"] > 0, "destination_cnpj"].iloc[:5].tolist()
+
+    response = api.score({"threshold": 95, "cnpj": cnpj, "company": company, "mun": mun})
+    assert response["dataset"] == datastore.DEFAULT_DATASET
+    assert response["threshold"] == "95"
+    expected = ([expected_result(data, "cnpj", value) for value in cnpj]
+                + [expected_result(data, "company", value) for value in company]
+                + [expected_result(data, "mun", value) for value in mun])
+    assert response["results"] == expected
+    assert not response["results"][-1]["found"]
+
+
+def test_cnpj_formats(data):
+    cnpj = data.asset_risk.loc[data.asset_risk["destination_cnpj"] > 0, "destination_cnpj"].iloc[0]
+    digits = f"{cnpj:.0f}"
+    punctuated = f"{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:]}"
+    results = api.score({"threshold": "95", "cnpj": [cnpj, int(cnpj), digits, punctuated]})["results"]
+    assert all(result["found"] for result in results)
+    assert len({json.dumps({**result, "value": None}) for result in results}) == 1
+    assert results[0] == expected_result(data, "cnpj", cnpj)
+
+
+@pytest.mark.parametrize("value", ["x", "", None, 0, "0", "00.000", -5, True, False, [1]])
+def test_invalid_cnpj_is_reported_alone(data, value):
+    cnpj = data.asset_risk.loc[data.asset_risk["destination_cnpj"] > 0, "destination_cnpj"].iloc[0]
+    invalid, valid = api.score({"threshold": "95", "cnpj": [value, cnpj]})["results"]
+    assert not invalid["found"]
+    assert invalid["value"] == value
+    assert invalid["error"] == f"Invalid CNPJ: {value!r}"
+    assert invalid["silos"] == invalid["links"] == invalid["origins"] == 0
+    assert valid == expected_result(data, "cnpj", cnpj)
+
+
+def test_silo_records(data):
+    mun = data.asset_risk["destination_mun"].value_counts().index[:3].tolist()
+    cnpj = data.asset_risk.loc[data.asset_risk["destination_cnpj"] > 0, "destination_cnpj"].iloc[:2].tolist()
+    response = api.score({"threshold": "95", "mun": mun, "cnpj": cnpj + ["x"], "silos": True})
+    lookups = [("cnpj", value) for value in cnpj] + [("cnpj", None)] + [("mun", value) for value in mun]
+    for result, (key, value) in zip(response["results"], lookups):
+        rows = data.asset_risk[data.asset_risk[api.KEYS[key]] == value]
+        expected = json.loads(rows[api.silo_columns].to_json(orient="records"))
+        assert result["silo_records"] == expected
+        assert len(result["silo_records"]) == result["silos"]
+
+
+@pytest.mark.parametrize("request_, message", [
+    ({"threshold": "50", "mun": ["SORRISO"]}, "Unknown risk threshold"),
+    ({"dataset": "soy_1900", "mun": ["SORRISO"]}, "Unknown dataset"),
+    ({"mun": "SORRISO"}, "must be a list"),
+    ({"company": [1]}, "must be a list of names"),
+    ({}, "Nothing to score"),
+])
+def test_invalid_requests(request_, message):
+    with pytest.raises(ValueError, match=message):
+        api.score(request_)
+
+
+def test_http_endpoint(data):
+    import app
+
+    client = app.server.test_client()
+    response = client.post("/api/v1/risk", json={"threshold": "95", "cnpj": ["x"], "mun": ["NOT A MUNICIPALITY"]})
+    assert response.status_code == 200
+    assert [result["found"] for result in response.json["results"]] == [False, False]
+    assert client.post("/api/v1/risk", json={"threshold": "50", "mun": ["X"]}).status_code == 400
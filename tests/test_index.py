@@ -0,0 +1,72 @@
+# FrameIndex row lookups, checked against a scan of the frames with isin
+import numpy as np
+import pytest
+
+import datastore
+
+COLUMNS = {"mun": "destination_mun", "company": "destination_company", "silo": "silo_ID",
+           "cnpj": "destination_cnpj"}
+
+
+def scan(frame, **selections):
+    mask = np.ones(len(frame), dtype=bool)
+    for name, values in selections.items():
+        if datastore.normalize_selection(values) == 'all':
+            continue
+        if isinstance(values, str):
+            values = [values]
+        mask &= frame[COLUMNS[name]].isin(values).to_numpy()
+    return np.flatnonzero(mask)
+
+
+# selections made of values of the frames: name -> function of the supply_shed frame returning rows() arguments
+def most_common(frame, column, count):
+    return frame[column].value_counts().index[:count].tolist()
+
+
+SELECTIONS = {
+    "one municipality": lambda frame: dict(mun=most_common(frame, "destination_mun", 1)),
+    "municipality as a string": lambda frame: dict(mun=most_common(frame, "destination_mun", 1)[0]),
+    "ten municipalities": lambda frame: dict(mun=most_common(frame, "destination_mun", 10)),
+    "all municipalities": lambda frame: dict(mun=["all"]),
+    "empty selection": lambda frame: dict(mun=[], company=[]),
+    "'all' among values": lambda frame: dict(mun=most_common(frame, "destination_mun", 2) + ["all"]),
+    "companies": lambda frame: dict(company=most_common(frame, "destination_company", 5)),
+    "municipalities and companies": lambda frame: dict(mun=most_common(frame, "destination_mun", 10),
+                                                       company=most_common(frame, "destination_company", 20)),
+    "unknown municipality": lambda frame: dict(mun=["NOT A MUNICIPALITY"]),
+    "unknown and known": lambda frame: dict(mun=["NOT A MUNICIPALITY"] + most_common(frame, "destination_mun", 1)),
+    "silos": lambda frame: dict(silo=frame["silo_ID"].drop_duplicates().iloc[::7].tolist()),
+    "silos and municipality": lambda frame: dict(silo=frame["silo_ID"].drop_duplicates().iloc[::3].tolist(),
+                                                 mun=most_common(frame, "destination_mun", 3)),
+    "CNPJs": lambda frame: dict(cnpj=frame["destination_cnpj"].drop_duplicates().iloc[:30].tolist()),
+}
+
+
+@pytest.mark.parametrize("table", ["supply_shed", "asset_risk"])
+@pytest.mark.parametrize("selection", SELECTIONS)
+def test_rows_match_scan(data, table, selection):
+    frame = getattr(data, table)
+    index = getattr(data, f"{table}_index")
+    selections = SELECTIONS[selection](data.supply_shed)
+
+    rows = index.rows(**selections)
+    expected = scan(frame, **selections)
+    if rows is None:
+        assert len(expected) == len(frame)
+    else:
+        np.testing.assert_array_equal(rows, expected)
+
+
+def test_select_returns_rows_of_both_frames(data):
+    mun = most_common(data.supply_shed, "destination_mun", 3)
+    supply_shed, asset_risk = data.select(mun=mun)
+    assert set(supply_shed["destination_mun"]) == set(mun)
+    assert set(asset_risk["destination_mun"]) == set(mun)
+    assert len(supply_shed) == len(scan(data.supply_shed, mun=mun))
+    assert len(asset_risk) == len(scan(data.asset_risk, mun=mun))
+
+
+def test_equal_selections_have_equal_keys():
+    assert datastore.selection_key("90", ["B", "A", "B"], "all") == datastore.selection_key(90, ["A", "B"], [])
+    assert datastore.selection_key("90", [], ["all", "X"]) == datastore.selection_key("90", "all", None)
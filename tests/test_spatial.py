@@ -0,0 +1,82 @@
+# SpatialIndex region and radius queries, checked against tests of every silo and municipality
+import numpy as np
+import pytest
+import shapely
+
+import datastore
+import spatial
+
+BOXES = [
+    (-56.5, -14.0, -55.5, -13.0),  # around NOVA MUTUM
+    (-60.0, -16.0, -50.0, -10.0),
+    (-55.0, -30.0, -49.0, -24.0),
+    (-75.0, -35.0, -30.0, 6.0),  # the whole country
+    (-40.0, -60.0, -35.0, -55.0),  # the ocean
+]
+# (lon, lat, km) circles; a None center is the first silo of the default hub
+CIRCLES = [(None, None, 10), (None, None, 50), (None, None, 0), (-52.0, -27.0, 150), (-30.0, -50.0, 100)]
+
+
+@pytest.fixture(scope="module")
+def index(data_dir):
+    return spatial.load_index()
+
+
+@pytest.fixture(scope="module")
+def silos(data_dir):
+    return datastore.get_dataset(datastore.DEFAULT_THRESHOLD).asset_risk
+
+
+@pytest.mark.parametrize("box", BOXES)
+def test_silos_in_bbox(index, silos, box):
+    west, south, east, north = box
+    lon, lat = silos["destination_long"], silos["destination_lat"]
+    inside = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+    assert index.silos_in_bbox(*box) == silos.loc[inside, "silo_ID"].tolist()
+
+
+def test_silos_in_polygon(index, silos):
+    triangle = shapely.Polygon([(-60, -16), (-50, -16), (-55, -8)])
+    inside = shapely.intersects(triangle, shapely.points(silos["destination_long"], silos["destination_lat"]))
+    assert index.silos_in(triangle) == silos.loc[inside, "silo_ID"].tolist()
+
+
+@pytest.mark.parametrize("lon, lat, km", CIRCLES)
+def test_silos_within(index, silos, lon, lat, km):
+    if lon is None:
+        lon, lat = silos[["destination_long", "destination_lat"]].iloc[0]
+    distances = spatial.haversine_km(lon, lat, silos["destination_long"].to_numpy(),
+                                     silos["destination_lat"].to_numpy())
+    expected = silos.loc[distances <= km, "silo_ID"]
+
+    found = index.silos_within(lon, lat, km)
+    assert sorted(found) == sorted(expected)
+    # nearest first
+    distance = dict(zip(silos["silo_ID"], distances))
+    found_distances = [distance[silo] for silo in found]
+    assert found_distances == sorted(found_distances)
+
+
+@pytest.mark.parametrize("box", BOXES)
+def test_municipalities_in_bbox(index, box):
+    geo = datastore.load_geo()
+    expected = geo.loc[geo.intersects(shapely.box(*box)), "origin_cod"]
+    assert sorted(index.municipalities_in_bbox(*box)) == sorted(expected)
+
+
+def test_select_region(silos):
+    data = datastore.get_dataset("95")
+    region = shapely.box(*BOXES[1])
+    supply_shed, asset_risk = spatial.select_region(data, region)
+    region_silos = spatial.load_index().silos_in(region)
+    assert asset_risk["silo_ID"].tolist() == data.asset_risk.loc[data.asset_risk["silo_ID"].isin(region_silos),
+                                                                 "silo_ID"].tolist()
+    assert len(supply_shed) == data.supply_shed["silo_ID"].isin(region_silos).sum()
+    assert spatial.select_region(data, shapely.box(*BOXES[4]))[0].empty
+
+
+def test_haversine_km():
+    # one degree of latitude, and São Paulo to Rio de Janeiro
+    assert spatial.haversine_km(0, 0, np.array([0]), np.array([1]))[0] == pytest.approx(111.2, abs=0.1)
+    assert spatial.haversine_km(-46.63, -23.55, np.array([-43.17]), np.array([-22.91]))[0] == pytest.approx(
+        361, abs=5)